@@ -0,0 +1,384 @@
+# Benchmarks for reading and writing dm3/dm4 files.
+# Synthetic files are generated from ndarray_to_dmdict, varying one thing
+# at a time from a small baseline: the image size, the number of tags, how
+# deeply they're nested, whether there's an array of structs and the file
+# version. Each of the read and write paths is then timed on every file,
+# and the results are written as JSON so runs can be compared between
+# releases, eg
+#   python -m dm_parser.benchmark_dm --profile quick -o before.json
+from __future__ import absolute_import, print_function, division
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+from array import array
+
+import numpy as np
+
+from .parse_dm3_grammar import (get_grammar, parse_dm_header,
+                                dm3_to_dictionary, dict_to_dm3)
+from .dm3_image_utils import ndarray_to_dmdict, load_image
+from .dm_tags import struct_array
+from .dm_writer import write_dm
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    timer = time.perf_counter
+except AttributeError:
+    timer = time.time
+
+MB = 1 << 20
+
+# every case changes one of these from the baseline
+baseline = dict(version=3, size=MB, tags=10, depth=1, struct_array=False)
+
+profiles = {
+    'quick': dict(size=[16 * MB], tags=[1000, 10000], depth=[16],
+                  struct_array=[True]),
+    'full': dict(size=[64 * MB, 1024 * MB, 4096 * MB],
+                 tags=[1000, 10000, 100000], depth=[8, 64],
+                 struct_array=[True]),
+}
+
+# dm3 lengths are signed 32 bit, so bigger files can only be dm4. This
+# leaves room for the tags alongside the image.
+dm3_max_size = 2048 * MB - 64 * MB
+
+
+def benchmark_cases(profile='quick', versions=(3, 4)):
+    """
+    Returns the list of cases (dictionaries with the keys of baseline) for
+    profile: the baseline, then each of the profile's values for each axis,
+    for every file version. dm3 cases bigger than dm3_max_size are left out.
+    """
+    cases = []
+    for version in versions:
+        cases.append(dict(baseline, version=version))
+        for axis, values in sorted(profiles[profile].items()):
+            cases.extend(dict(baseline, version=version, **{axis: v})
+                         for v in values)
+    return [c for c in cases
+            if c['version'] != 3 or c['size'] <= dm3_max_size]
+
+
+def case_name(case):
+    return 'dm%(version)d_%(size)dMB_%(tags)dtags_depth%(depth)d' % dict(
+        case, size=case['size'] // MB) + ('_structs' if case['struct_array']
+                                          else '')
+
+
+def synthetic_tags(count, depth):
+    """
+    Returns a tag dictionary holding count tags spread evenly over depth
+    levels of nested sections. The tags cycle through ints, floats,
+    structs and strings (arrays of uint16).
+    """
+    levels = [{}]
+    for i in range(1, depth):
+        levels.append({})
+        levels[-2]['Level%d' % i] = levels[-1]
+    for i in range(count):
+        value = (i, float(i), (i, float(i)),
+                 array('H', [ord(c) for c in 'tag%d' % i]))[i % 4]
+        levels[i % depth]['Tag%d' % i] = value
+    return levels[0]
+
+
+def synthetic_dmdict(case):
+    """
+    Returns the tag dictionary for case: a float32 image of about
+    case['size'] bytes, with case['tags'] tags (see synthetic_tags) as its
+    ImageTags and optionally a 10000 entry array of structs.
+    """
+    n = max(1, case['size'] // 4)
+    width = min(n, 1024)
+    im = np.arange(n // width * width, dtype=np.float32).reshape(-1, width)
+    d = ndarray_to_dmdict(im)
+    image = d['ImageList'][0]
+    image['ImageTags'] = synthetic_tags(case['tags'], case['depth'])
+    if case['struct_array']:
+        image['ImageTags']['StructArray'] = struct_array(
+            'if', ((i, i / 2) for i in range(10000)))
+    return d
+
+
+# Each benchmark is called with a _Case before every repeat and returns the
+# function to time, so its setup isn't counted. They return the number of
+# bytes they process.
+def _parse_dm_header(case):
+    def run():
+        with open(case.path, 'rb') as f:
+            parse_dm_header(f)
+        return case.file_size
+    return run
+
+
+def _grammar_open(case):
+    def run():
+        with open(case.path, 'rb') as f:
+            case.grammar.open(f)
+        return case.file_size
+    return run
+
+
+def _dm3_to_dictionary(case):
+    f = open(case.path, 'rb')
+    parsed = case.grammar.open(f)
+
+    def run():
+        try:
+            dm3_to_dictionary(parsed)
+        finally:
+            f.close()
+        return case.file_size
+    return run
+
+
+def _load_image(case):
+    def run():
+        return load_image(case.path).nbytes
+    return run
+
+
+def _load_image_mmap(case):
+    def run():
+        return load_image(case.path, mmap=True).nbytes
+    return run
+
+
+def _dict_to_dm3(case):
+    def run():
+        dict_to_dm3(case.dmdict)
+        return case.file_size
+    return run
+
+
+def _grammar_save(case):
+    if case.parsed is None:
+        case.parsed = dict_to_dm3(case.dmdict)
+
+    def run():
+        with open(case.out_path, 'wb') as f:
+            case.grammar.save(f, case.parsed)
+        return case.file_size
+    return run
+
+
+def _write_dm(case):
+    def run():
+        with open(case.out_path, 'wb') as f:
+            write_dm(f, case.dmdict, case.version)
+        return case.file_size
+    return run
+
+
+# (name, function, whether it goes through the grammar) in the order run
+benchmarks = [('parse_dm_header', _parse_dm_header, True),
+              ('grammar_open', _grammar_open, True),
+              ('dm3_to_dictionary', _dm3_to_dictionary, True),
+              ('load_image', _load_image, False),
+              ('load_image_mmap', _load_image_mmap, False),
+              ('dict_to_dm3', _dict_to_dm3, True),
+              ('grammar_save', _grammar_save, True),
+              ('write_dm', _write_dm, False)]
+
+
+def _case_path(case, directory):
+    return os.path.join(directory, case_name(case) + '.dm%d'
+                        % case['version'])
+
+
+def _remove_case_files(case, directory):
+    path = _case_path(case, directory)
+    for p in (path, path + '.out'):
+        if os.path.exists(p):
+            os.remove(p)
+
+
+class _Case(object):
+    def __init__(self, case, directory):
+        self.case = case
+        self.directory = directory
+        self.version = case['version']
+        self.path = _case_path(case, directory)
+        self.out_path = self.path + '.out'
+        self.grammar = get_grammar('dm%d' % self.version)
+        self.dmdict = synthetic_dmdict(case)
+        self.parsed = None
+        with open(self.path, 'wb') as f:
+            write_dm(f, self.dmdict, self.version)
+        self.file_size = os.path.getsize(self.path)
+
+    def remove(self):
+        _remove_case_files(self.case, self.directory)
+
+
+def max_rss():
+    """The peak resident set size of the process so far in bytes, or None"""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def time_benchmark(func, case, repeat=3, memory=True):
+    """
+    Times func (see benchmarks) on case repeat times. Returns a dictionary
+    of the fastest and median times in seconds, the throughput of the
+    fastest in MB/s and, if memory is True, the peak memory python
+    allocated during an extra traced run (None without tracemalloc) and the
+    process's peak RSS afterwards.
+    """
+    times = []
+    nbytes = 0
+    for i in range(repeat):
+        run = func(case)
+        start = timer()
+        nbytes = run()
+        times.append(timer() - start)
+    times.sort()
+    ret = dict(seconds=times[0], median_seconds=times[len(times) // 2],
+               bytes=nbytes, mb_per_second=nbytes / MB / max(times[0], 1e-9))
+    if memory:
+        peak = None
+        if tracemalloc is not None:
+            run = func(case)
+            tracemalloc.start()
+            try:
+                run()
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+        ret.update(peak_traced_bytes=peak, max_rss_bytes=max_rss())
+    return ret
+
+
+def run_benchmarks(cases, directory=None, repeat=3, memory=True, only=None,
+                   max_grammar_size=64 * MB, progress=None):
+    """
+    Generates a file for each of cases in directory (by default a temporary
+    directory) and runs benchmarks on it, only those named in only if it's
+    given. Benchmarks going through the grammar are skipped for files
+    bigger than max_grammar_size, as it holds every value as a python
+    object. progress, if given, is called with each result as it's made.
+    A case whose file can't be made, or a benchmark that fails, records
+    the traceback as its error and the run carries on with the rest.
+    Returns the JSON-able results: a dictionary of details about the
+    machine and a list of results, one per case.
+    """
+    temp_dir = directory is None
+    if temp_dir:
+        directory = tempfile.mkdtemp(prefix='dm_benchmark')
+    results = []
+    try:
+        for c in cases:
+            result = dict(c, name=case_name(c), benchmarks={})
+            try:
+                case = _Case(c, directory)
+            except Exception:
+                result['error'] = traceback.format_exc().strip()
+                _remove_case_files(c, directory)
+                results.append(result)
+                if progress:
+                    progress(result)
+                continue
+            result['file_size'] = case.file_size
+            try:
+                for name, func, uses_grammar in benchmarks:
+                    if only and name not in only:
+                        continue
+                    if uses_grammar and case.file_size > max_grammar_size:
+                        result['benchmarks'][name] = dict(
+                            skipped='file bigger than max_grammar_size')
+                        continue
+                    try:
+                        result['benchmarks'][name] = time_benchmark(
+                            func, case, repeat, memory)
+                    except Exception:
+                        result['benchmarks'][name] = dict(
+                            error=traceback.format_exc().strip())
+            finally:
+                case.remove()
+            results.append(result)
+            if progress:
+                progress(result)
+    finally:
+        if temp_dir:
+            shutil.rmtree(directory, ignore_errors=True)
+    return dict(machine=dict(python=platform.python_version(),
+                             implementation=platform.python_implementation(),
+                             platform=platform.platform(),
+                             numpy=np.__version__),
+                time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                repeat=repeat, results=results)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark reading and writing synthetic dm3/dm4 files")
+    parser.add_argument('--profile', choices=sorted(profiles),
+                        default='quick', help="which cases to run")
+    parser.add_argument('-o', '--output',
+                        help="file to write the JSON results to "
+                             "(default: stdout)")
+    parser.add_argument('-n', '--repeat', type=int, default=3,
+                        help="times to run each benchmark (default: 3)")
+    parser.add_argument('-b', '--benchmark', action='append', dest='only',
+                        choices=[b[0] for b in benchmarks],
+                        help="only run this benchmark, can be given more "
+                             "than once")
+    parser.add_argument('-d', '--dir',
+                        help="where to write the generated files (default: "
+                             "a temporary directory)")
+    parser.add_argument('--max-grammar-mb', type=int, default=64,
+                        help="skip grammar benchmarks on files bigger than "
+                             "this (default: 64)")
+    parser.add_argument('--no-memory', action='store_false', dest='memory',
+                        help="don't measure peak memory use")
+    args = parser.parse_args(argv)
+
+    def progress(result):
+        print(result['name'], file=sys.stderr)
+        if 'error' in result:
+            print("  failed: %s" % result['error'].splitlines()[-1],
+                  file=sys.stderr)
+        for name, b in result['benchmarks'].items():
+            if 'skipped' in b:
+                print("  %-18s skipped" % name, file=sys.stderr)
+            elif 'error' in b:
+                print("  %-18s failed: %s" % (name,
+                                              b['error'].splitlines()[-1]),
+                      file=sys.stderr)
+            else:
+                print("  %-18s %9.4fs %9.1f MB/s" % (
+                    name, b['seconds'], b['mb_per_second']), file=sys.stderr)
+
+    results = run_benchmarks(benchmark_cases(args.profile), args.dir,
+                             args.repeat, args.memory, args.only,
+                             args.max_grammar_mb * MB, progress)
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        json.dump(results, out, indent=1, sort_keys=True)
+        out.write('\n')
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+# Headless bulk conversion of dm3/dm4 files to .npy, raw or TIFF files.
+# Files are converted in parallel on a process pool. Each file is loaded
+# through the memory mapped path in dm3_image_utils, so the image data is
+# written out straight from the mapped file without being decoded first.
+from __future__ import absolute_import, print_function, division
+import argparse
+import glob
+import logging
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from .dm3_image_utils import load_image
+from .dm_compressed import strip_compressed_extension
+
+try:
+    import PIL.Image
+    has_pil = True
+except ImportError:
+    has_pil = False
+
+dm_extensions = ('.dm3', '.dm4')
+formats = ('npy', 'raw', 'tiff')
+
+
+def find_dm_files(inputs, recursive=False):
+    """
+    Returns the sorted dm3/dm4 files named by inputs, each of which is a
+    file, a directory or a glob pattern. Compressed files, eg .dm3.gz, are
+    included.
+    """
+    found = set()
+    for i in inputs:
+        if os.path.isdir(i):
+            if recursive:
+                for dirpath, dirnames, filenames in os.walk(i):
+                    found.update(os.path.join(dirpath, f) for f in filenames)
+            else:
+                found.update(os.path.join(i, f) for f in os.listdir(i))
+        else:
+            found.update(glob.glob(i))
+    return sorted(f for f in found if os.path.splitext(
+        strip_compressed_extension(f))[1].lower() in dm_extensions)
+
+
+def save_tiff(path, im):
+    if im.ndim == 2:
+        PIL.Image.fromarray(im).save(path)
+    else:
+        frames = [PIL.Image.fromarray(x)
+                  for x in im.reshape((-1,) + im.shape[-2:])]
+        frames[0].save(path, save_all=True, append_images=frames[1:])
+
+
+def output_base(path, out_dir=None):
+    """
+    The path, without an extension, that convert_file writes the output
+    for path to: its base name in out_dir, by default next to path.
+    """
+    base = os.path.splitext(os.path.basename(
+        strip_compressed_extension(path)))[0]
+    return os.path.join(out_dir or os.path.dirname(path), base)
+
+
+def convert_file(path, out_dir=None, out_formats=('npy',)):
+    """
+    Converts the dm3/dm4 file at path into each of out_formats, writing
+    them to out_dir (by default next to path) with the same base name.
+    Returns (path, number of image bytes, list of files written, error),
+    where error is None or a description of what went wrong, so one bad
+    file doesn't stop a batch.
+    """
+    written = []
+    try:
+        im = load_image(path, mmap=True)
+        out_base = output_base(path, out_dir)
+        for fmt in out_formats:
+            out = out_base + '.' + fmt
+            if fmt == 'npy':
+                np.save(out, im)
+            elif fmt == 'raw':
+                # raw files are the pixels in C order, little-endian as
+                # in the dm file itself
+                im.astype(im.dtype.newbyteorder('<'), copy=False).tofile(out)
+            elif fmt == 'tiff':
+                if not has_pil:
+                    raise ValueError("TIFF output needs PIL")
+                save_tiff(out, im)
+            else:
+                raise ValueError("Unknown format %r" % fmt)
+            written.append(out)
+        return path, im.nbytes, written, None
+    except Exception:
+        return path, 0, written, traceback.format_exc().strip()
+
+
+def _convert_results(paths, out_dir, out_formats, workers):
+    # yields the convert_file result for each of paths, as it's known
+    first = {}
+    to_convert = []
+    for p in paths:
+        out_base = os.path.abspath(output_base(p, out_dir))
+        if out_base in first:
+            yield p, 0, [], "Output %s.* would overwrite that of %s" % (
+                out_base, first[out_base])
+        else:
+            first[out_base] = p
+            to_convert.append(p)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = dict((pool.submit(convert_file, p, out_dir, out_formats), p)
+                       for p in to_convert)
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception:
+                # eg BrokenProcessPool, if a worker died converting it
+                yield (futures[future], 0, [],
+                       traceback.format_exc().strip())
+
+
+def convert_files(paths, out_dir=None, out_formats=('npy',), workers=None,
+                  progress=None):
+    """
+    Converts every file in paths on a pool of workers processes (by
+    default one per CPU). progress, if given, is called with the result of
+    convert_file for each file as it finishes. Returns a summary dictionary
+    with the counts of files converted and failed, the image bytes written,
+    the time taken and the resulting files/s and MB/s.
+    Files whose output would overwrite that of an earlier file in paths
+    (eg a.dm3 and a.dm4, or files of the same name from different
+    directories going to one out_dir) fail without being converted. If a
+    worker process dies, the files it left unconverted fail too.
+    """
+    if out_dir and not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    start = time.time()
+    done = failed = nbytes = 0
+    for result in _convert_results(paths, out_dir, out_formats, workers):
+        if result[3] is None:
+            done += 1
+            nbytes += result[1]
+        else:
+            failed += 1
+        if progress:
+            progress(result)
+    elapsed = max(time.time() - start, 1e-9)
+    return dict(converted=done, failed=failed, bytes=nbytes,
+                seconds=elapsed, files_per_second=(done + failed) / elapsed,
+                mb_per_second=nbytes / elapsed / 1e6)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Convert dm3/dm4 files to npy, raw or tiff files")
+    parser.add_argument('inputs', nargs='+',
+                        help="files, directories or glob patterns")
+    parser.add_argument('-o', '--out-dir',
+                        help="where to write the output (default: next to "
+                             "each input)")
+    parser.add_argument('-f', '--format', action='append', choices=formats,
+                        dest='formats',
+                        help="output format, can be given more than once "
+                             "(default: npy)")
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help="number of worker processes (default: one per "
+                             "CPU)")
+    parser.add_argument('-r', '--recursive', action='store_true',
+                        help="search directories recursively")
+    args = parser.parse_args(argv)
+    logging.basicConfig()
+
+    def progress(result):
+        path, nbytes, written, error = result
+        if error is None:
+            print("converted %s -> %s" % (path, ", ".join(written)))
+        else:
+            print("FAILED %s:\n%s" % (path, error), file=sys.stderr)
+
+    paths = find_dm_files(args.inputs, args.recursive)
+    summary = convert_files(paths, args.out_dir, args.formats or ['npy'],
+                            args.workers, progress)
+    print("%(converted)d converted, %(failed)d failed in %(seconds).2fs: "
+          "%(files_per_second).1f files/s, %(mb_per_second).1f MB/s" % summary)
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -12,8 +12,17 @@
 # datratypes in describing the data.
 from __future__ import absolute_import, print_function, division
 from .parse_dm3_grammar import *
+from .dm_tags import DMTagReader, TagFilter, numpy_dtype
+from .dm_index import TagIndex
+from .dm_stats import phase
+from .dm_stream import seekable, stream_dm_tags
+from .dm_compressed import CompressedFile, decompressed, open_dm_file
+from .dm_writer import write_dm, StreamedArray, DMStreamWriter
 import numpy as np
+import logging
+import mmap as _mmap
 from array import array
+from collections import OrderedDict
 
 
 # we want to amp any image type to a single np array type
@@ -23,15 +32,14 @@ from array import array
 # convert np bool type eg to DM bool and treat y,x,3 int8 images
 # as RGB.
 
-# note uint8 here returns the same data type as int8 - could be that the
-# only way they're differentiated is via this type, not the raw type
-# in the tag file? Might be same for PackedComplex images too
+# uint8 images keep their data as DM type 10 (unsigned) arrays.
+# Might be same for PackedComplex images too
 # And 8 is missing!
 dm_image_dtypes = {
     1: ("int16", np.int16),
     2: ("float32", np.float32),
     3: ("Complex64", np.complex64),
-    6: ("uint8", np.int8),
+    6: ("uint8", np.uint8),
     7: ("int32", np.int32),
     9: ("int8", np.int8),
     10: ("uint16", np.uint16),
@@ -45,20 +53,64 @@ dm_image_dtypes = {
 }
 
 
+def unpack_packed_complex(packed, dtype=np.complex64):
+    """
+    Unpacks the 2d packed complex array packed, returning the full complex
+    FFT (in the same layout np.fft.fft2 uses) as an array of dtype.
+    Packed complex images hold the FFT of a real h x w image in h x w reals.
+    Columns kx = 1 .. w/2-1 are stored as (real, imag) column pairs starting
+    at column 2. Columns kx = 0 and w/2 are themselves the FFTs of real
+    sequences and are packed the same way down columns 0 and 1: the real
+    values for ky = 0 and h/2 come first, then (real, imag) pairs. The rest
+    of the FFT follows from it being Hermitian.
+    """
+    h, w = packed.shape
+    if h % 2 or w % 2:
+        raise ValueError("Packed complex images must have even dimensions")
+    hh, hw = h // 2, w // 2
+    out = np.empty((h, w), dtype)
+    out[:, 1:hw] = packed[:, 2::2] + 1j * packed[:, 3::2]
+    for col, src in ((0, packed[:, 0]), (hw, packed[:, 1])):
+        out[0, col] = src[0]
+        out[hh, col] = src[1]
+        out[1:hh, col] = src[2::2] + 1j * src[3::2]
+        out[hh + 1:, col] = np.conj(out[hh - 1:0:-1, col])
+    # F[-ky, -kx] = conj(F[ky, kx]) for the columns we haven't filled yet
+    out[:, hw + 1:] = np.conj(out[-np.arange(h) % h, hw - 1:0:-1])
+    return out
+
+
 def imagedatadict_to_ndarray(imdict):
     """
     Converts the ImageData dictionary, imdict, to an nd image.
+    Complex images are returned as complex views onto the data and RGB
+    images as (..., 4) uint8 views, with channels R, G, B, A. Packed complex
+    images are unpacked into a new complex array (see unpack_packed_complex).
     """
     arr = imdict['Data']
     im = None
-    if isinstance(arr, array):
+    if isinstance(arr, np.ndarray):
+        # already a view on the file (see load_image), use as is
+        im = arr
+    elif isinstance(arr, array):
         im = np.asarray(arr, dtype=arr.typecode)
     else:
-        raise NotImplementedError('cannot load complex types yet')
-    print("Image has dmimagetype", imdict["DataType"], "numpy type is", im.dtype)
-    assert dm_image_dtypes[imdict["DataType"]][1] == im.dtype
+        raise NotImplementedError('cannot load data of type %s' % type(arr))
+    dm_type = imdict["DataType"]
+    shape = tuple(imdict['Dimensions'][::-1])
+    logging.debug("Image has dmimagetype %s, numpy type is %s", dm_type,
+                  im.dtype)
+    if dm_type in (3, 13):
+        # stored as (real, imag) structs (or pairs of reals)
+        im = im.view(dm_image_dtypes[dm_type][1])
+    elif dm_type == 23:
+        return im.view(np.uint8).reshape(shape + (4,))
+    elif dm_type in (27, 28):
+        complex_type = {27: np.complex64, 28: np.complex128}[dm_type]
+        return unpack_packed_complex(im.reshape(shape), complex_type)
+    assert dm_image_dtypes[dm_type][1] == im.dtype
     assert imdict['PixelDepth'] == im.dtype.itemsize
-    return im.reshape(imdict['Dimensions'][::-1])
+    return im.reshape(shape)
 
 
 def ndarray_to_imagedatadict(nparr):
@@ -66,13 +118,16 @@ def ndarray_to_imagedatadict(nparr):
     Convert the numpy array nparr into a suitable ImageList entry dictionary.
     Returns a dictionary with the appropriate Data, DataType, PixelDepth
     to be inserted into a dm3 tag dictionary and written to a file.
+    The data is kept as a flat numpy array, which is a view onto nparr
+    whenever nparr is contiguous.
     """
     ret = {}
-    dm_type = (k for k, v in dm_image_dtypes.iteritems() if v[1] == nparr.dtype.type).next()
+    dm_type = next(k for k, v in dm_image_dtypes.items()
+                   if v[1] == nparr.dtype.type)
     ret["DataType"] = dm_type
     ret["PixelDepth"] = nparr.dtype.itemsize
     ret["Dimensions"] = list(nparr.shape[::-1])
-    ret["Data"] = array(nparr.dtype.char, nparr.flatten())
+    ret["Data"] = np.ascontiguousarray(nparr).reshape(-1)
     return ret
 
 def ndarray_to_dmdict(ndarray):
@@ -84,7 +139,7 @@ def ndarray_to_dmdict(ndarray):
     ret = {}
     ret["ImageList"] = [{"ImageData": image}]
     # I think ImageSource list creates a mapping between ImageSourceIds and Images
-    ret["ImageSourceList"] = [{"ClassName": array('H', "ImageSource:Simple".encode('utf_16_le')), "Id": [0], "ImageRef": 0}]
+    ret["ImageSourceList"] = [{"ClassName": array('H', [ord(c) for c in "ImageSource:Simple"]), "Id": [0], "ImageRef": 0}]
     # I think this lists the sources for the DocumentObjectlist. The source number is not
     # the indxe in the imagelist but is either the index in the ImageSourceList or the Id
     # from that list. We also need to set the annotation type to identify it as an image
@@ -94,17 +149,541 @@ def ndarray_to_dmdict(ndarray):
     ret["InImageMode"] = 1
     return ret
 
-def load_image(file):
+def mmap_array_reader(f):
+    """
+    Returns an array reader for read_dm_tags that maps the real file behind
+    f into memory and returns arrays as read-only numpy views onto it.
+    Nothing is decoded or copied; the mapping stays alive as long as any of
+    the returned arrays do, even after f is closed.
+    """
+    return mapped_array_reader(
+        _mmap.mmap(f.fileno(), 0, access=_mmap.ACCESS_READ))
+
+def mapped_array_reader(mapped):
+    """
+    Returns an array reader for read_dm_tags that returns arrays as numpy
+    views onto mapped, a memory map (or any other buffer) of the whole file.
+    """
+    def reader(f, ref):
+        return np.frombuffer(mapped, dtype=numpy_dtype(ref.typecode),
+                             count=ref.count, offset=ref.offset)
+    return reader
+
+
+def save_image(file, ndarray, version=3):
+    """
+    Saves ndarray as the only image in a new dm3 (version=3) or dm4
+    (version=4) file. file is either a file-like object or a path.
+    The image data goes to the file with a single write, straight from
+    ndarray's memory if it's contiguous and little endian.
+    """
+    if isinstance(file, str):
+        with open(file, "wb") as f:
+            return save_image(f, ndarray, version)
+    write_dm(file, ndarray_to_dmdict(ndarray), version)
+
+class ImageStreamWriter(object):
+    """
+    Writes an image to a new dm3 (version=3) or dm4 (version=4) file one
+    chunk at a time, so only a chunk ever needs to be in memory.
+    shape and dtype describe the whole image. shape[0] (eg the number of
+    frames) can be None if it isn't known yet, in which case it's worked out
+    from the data written and patched into the file on close; file must be
+    seekable for that.
+    Chunks are arrays of dtype that together make up the image in C order,
+    eg whole frames or rows. file is a file-like object or a path.
+    """
+    def __init__(self, file, shape, dtype, version=3):
+        self.own_file = isinstance(file, str)
+        self.f = open(file, "wb") if self.own_file else file
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.frame_size = int(np.prod(self.shape[1:], dtype=np.int64))
+        dims = list(self.shape)
+        if dims[0] is None:
+            dims[0] = 0
+        tags = ndarray_to_dmdict(np.empty(0, self.dtype))
+        image = tags.pop("ImageList")[0]["ImageData"]
+        image.pop("Data")
+        image = OrderedDict(sorted(image.items()))
+        image["Dimensions"] = dims[::-1]
+        # the image data has to be the last thing in the file
+        image["Data"] = StreamedArray(self.dtype, dims[0] * self.frame_size)
+        tags = OrderedDict(sorted(tags.items()))
+        tags["ImageList"] = [{"ImageData": image}]
+        self.writer = DMStreamWriter(self.f, tags, version)
+        self.count = 0
+
+    def write(self, chunk):
+        chunk = np.asarray(chunk, self.dtype)
+        self.count += chunk.size
+        if self.shape[0] is not None and (
+                self.count > self.shape[0] * self.frame_size):
+            raise ValueError("More data than the declared shape %s" % (
+                self.shape,))
+        self.writer.write_chunk(chunk)
+
+    def close(self):
+        try:
+            if self.shape[0] is None:
+                if self.count % self.frame_size:
+                    raise ValueError("Data isn't a whole number of frames")
+                self.writer.patch(
+                    ("ImageList", "0", "ImageData", "Dimensions",
+                     str(len(self.shape) - 1)),
+                    self.count // self.frame_size)
+            elif self.count != self.shape[0] * self.frame_size:
+                raise ValueError("Expected %d elements, got %d" % (
+                    self.shape[0] * self.frame_size, self.count))
+            self.writer.close()
+        finally:
+            if self.own_file:
+                self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.own_file:
+            self.f.close()
+
+def save_image_stream(file, shape, dtype, chunks, version=3):
+    """
+    Saves an image that arrives in chunks (see ImageStreamWriter) to file.
+    chunks is either an iterable of arrays or a function that returns the
+    next chunk each time it's called, and None once there are no more.
+    """
+    with ImageStreamWriter(file, shape, dtype, version) as writer:
+        if callable(chunks):
+            chunk = chunks()
+            while chunk is not None:
+                writer.write(chunk)
+                chunk = chunks()
+        else:
+            for chunk in chunks:
+                writer.write(chunk)
+
+class DMImage(object):
+    """
+    One entry of a file's ImageList, as found in DMFile.images.
+    tags is the entry's tag dictionary, which holds everything but the pixel
+    data itself. shape and dtype describe the array data will return, which
+    is only read (and decoded) the first time it's asked for.
+    """
+    def __init__(self, dm_file, tags, data_tag):
+        self.dm_file = dm_file
+        self.tags = tags
+        self.data_tag = data_tag
+        self._data = None
+
+    @property
+    def dm_type(self):
+        return self.tags['ImageData']['DataType']
+
+    @property
+    def shape(self):
+        shape = tuple(self.tags['ImageData']['Dimensions'][::-1])
+        return shape + (4,) if self.dm_type == 23 else shape
+
+    @property
+    def dtype(self):
+        if self.dm_type == 23:
+            return np.dtype(np.uint8)
+        elif self.dm_type in (27, 28):
+            return np.dtype({27: np.complex64, 28: np.complex128}[
+                self.dm_type])
+        return np.dtype(dm_image_dtypes[self.dm_type][1])
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self.dm_file.read_image_data(self)
+        return self._data
+
+    def stack(self, readahead=0):
+        """
+        Returns an ImageStack giving indexed access to the image's data,
+        reading only what each index needs. See ImageStack for readahead.
+        """
+        if self.data_tag is None:
+            raise ValueError("Image has no data")
+        return ImageStack(self.dm_file.f, self.data_tag.offset, self.shape,
+                          self.dm_type, readahead, self.dm_file.mapped)
+
+    def __repr__(self):
+        return "DMImage(shape=%r, dtype=%s)" % (self.shape, self.dtype)
+
+class ImageStack(object):
+    """
+    Reads parts of an image straight from the file-like object f, where its
+    data starts at offset, without loading the rest. Indexing works like it
+    does for the ndarray load_image would return, with integers, slices and
+    an Ellipsis, eg stack[i], stack[i:j] or stack[:, y, x] for a 3d stack.
+    Each index is turned into the runs of bytes it covers, and only those
+    are read, adjacent runs being merged into single reads. RGB images
+    can't be indexed by channel, their last axis always comes back whole.
+    If readahead is given, every read fetches at least that many bytes and
+    keeps them for the next index, which makes iterating over the frames
+    of a stack take far fewer reads.
+    If mapped is given, a memory map of the whole file, the bytes are
+    copied from it instead of being read from f.
+    f (or mapped) must stay open while the stack is used.
+    """
+    def __init__(self, f, offset, shape, dm_type, readahead=0, mapped=None):
+        if dm_type in (27, 28):
+            raise NotImplementedError(
+                "Packed complex images can't be read in parts")
+        self.f = f
+        self.offset = offset
+        self.dm_type = dm_type
+        self.rgb = dm_type == 23
+        # the shape and dtype of the data as it's stored
+        self.stored_shape = tuple(shape[:-1] if self.rgb else shape)
+        self.stored_dtype = np.dtype('<u4' if self.rgb
+                                     else dm_image_dtypes[dm_type][1])
+        self.stored_dtype = self.stored_dtype.newbyteorder('<')
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(np.uint8) if self.rgb else self.stored_dtype
+        self.readahead = readahead
+        self.mapped = mapped
+        self._cache_start = 0
+        self._cache = b''
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def _ranges(self, key):
+        # a range per stored axis and whether that axis is kept
+        if not isinstance(key, tuple):
+            key = (key,)
+        if Ellipsis in key:
+            i = key.index(Ellipsis)
+            key = (key[:i] + (slice(None),) * (
+                len(self.stored_shape) - len(key) + 1) + key[i + 1:])
+        if len(key) > len(self.stored_shape):
+            raise IndexError("Too many indices for a stack of shape %s" % (
+                self.shape,))
+        key = key + (slice(None),) * (len(self.stored_shape) - len(key))
+        ranges = []
+        for k, n in zip(key, self.stored_shape):
+            if isinstance(k, slice):
+                ranges.append((range(*k.indices(n)), True))
+            else:
+                k = int(k)
+                if not -n <= k < n:
+                    raise IndexError("Index %d out of range" % k)
+                ranges.append((range(k % n, k % n + 1), False))
+        return ranges
+
+    def _runs(self, ranges):
+        # the (offset, count) in elements of each run to read, merged
+        shape = self.stored_shape
+        strides = [int(np.prod(shape[a + 1:], dtype=np.int64))
+                   for a in range(len(shape))]
+        # everything after the last partly wanted axis is read whole
+        last = max([a for a, (r, kept) in enumerate(ranges)
+                    if len(r) != shape[a] or r.step != 1] or [-1])
+        block = strides[last] if last >= 0 else int(
+            np.prod(shape, dtype=np.int64))
+        outer = ranges[:last]
+        if last >= 0 and ranges[last][0].step == 1:
+            block *= len(ranges[last][0])
+            first = ranges[last][0].start * strides[last] if len(
+                ranges[last][0]) else 0
+        else:
+            outer = ranges[:last + 1]
+            first = 0
+        runs = []
+        for idx in np.ndindex(*[len(r) for r, kept in outer]):
+            start = first + sum(r[i] * strides[a]
+                                for a, ((r, kept), i) in enumerate(
+                                    zip(outer, idx)))
+            if runs and runs[-1][0] + runs[-1][1] == start:
+                runs[-1][1] += block
+            else:
+                runs.append([start, block])
+        return runs
+
+    def _read(self, pos, buf):
+        # reads len(buf) bytes from pos in the file into the uint8 array buf
+        n = len(buf)
+        if self.mapped is not None:
+            buf[:] = np.frombuffer(self.mapped, np.uint8, n, pos)
+            return
+        cached = pos - self._cache_start
+        if not (0 <= cached and cached + n <= len(self._cache)):
+            self.f.seek(pos)
+            if self.readahead > n:
+                self._cache_start, cached = pos, 0
+                self._cache = self.f.read(self.readahead)
+            elif hasattr(self.f, 'readinto'):
+                if self.f.readinto(buf) != n:
+                    raise ValueError("Unexpected end of file at %d" % pos)
+                return
+            else:
+                self._cache_start, cached = pos, 0
+                self._cache = self.f.read(n)
+            if len(self._cache) < n:
+                raise ValueError("Unexpected end of file at %d" % pos)
+        buf[:] = np.frombuffer(self._cache, np.uint8, n, cached)
+
+    def __getitem__(self, key):
+        ranges = self._ranges(key)
+        out = np.empty([len(r) for r, kept in ranges], self.stored_dtype)
+        flat = out.reshape(-1).view(np.uint8)
+        itemsize = self.stored_dtype.itemsize
+        pos = 0
+        for start, count in self._runs(ranges):
+            n = count * itemsize
+            self._read(self.offset + start * itemsize, flat[pos:pos + n])
+            pos += n
+        out = out.reshape([len(r) for r, kept in ranges if kept])
+        if self.rgb:
+            return out.view(np.uint8).reshape(out.shape + (4,))
+        return out
+
+    def read(self):
+        """Reads the whole image"""
+        return self[...]
+
+    def region(self, roi=None, bin=None, band_bytes=16 << 20):
+        """
+        Reads the region roi = (y0, y1, x0, x1) of the last two image axes
+        (the rows and columns, for every frame of a stack), by default all
+        of them, and bins it by bin = (by, bx) if that's given.
+        Binned pixels are the mean of each by x bx block as floats (complex
+        for complex images), and partial blocks at the bottom and right edges are left out. The
+        region is then read and binned about band_bytes at a time, so only
+        the binned result is ever held in full.
+        """
+        ny, nx = self.stored_shape[-2:]
+        y0, y1, x0, x1 = roi or (0, ny, 0, nx)
+        y0, y1 = slice(y0, y1).indices(ny)[:2]
+        x0, x1 = slice(x0, x1).indices(nx)[:2]
+        if bin is None:
+            return self[..., y0:y1, x0:x1]
+        by, bx = bin
+        # only whole bins
+        y1 = y0 + max(y1 - y0, 0) // by * by
+        x1 = x0 + max(x1 - x0, 0) // bx * bx
+        lead = self.stored_shape[:-2]
+        channels = (4,) if self.rgb else ()
+        out = np.empty(lead + ((y1 - y0) // by, (x1 - x0) // bx) + channels,
+                       np.complex128 if self.dtype.kind == 'c'
+                       else np.float64)
+        # the axis of the rows in the output, and in each band
+        yaxis = len(lead)
+        row_bytes = max(1, (x1 - x0) * self.stored_dtype.itemsize *
+                        int(np.prod(lead, dtype=np.int64)))
+        band = max(1, band_bytes // (row_bytes * by)) * by
+        for y in range(y0, y1, band):
+            part = self[..., y:min(y + band, y1), x0:x1]
+            part = part.reshape(lead + (part.shape[yaxis] // by, by,
+                                        (x1 - x0) // bx, bx) + channels)
+            i = (y - y0) // by
+            out[(Ellipsis, slice(i, i + part.shape[yaxis])) +
+                (slice(None),) * (1 + len(channels))] = part.mean(
+                    axis=(yaxis + 1, yaxis + 3))
+        return out
+
+class DMFile(object):
+    """
+    An open dm3 or dm4 file whose tags have been read, except for the pixel
+    data of its images, see open_dm.
+    tags is the file's tag dictionary, without the ImageData Data tags, and
+    images the list of DMImage, one per ImageList entry.
+    """
+    def __init__(self, f, own_file=False, mmap=False, stats=None):
+        self.own_file = own_file
+        self.f = f if stats is None else stats.wrap(f)
+        self.stats = stats
+        self.mapped = self.array_reader = None
+        if mmap:
+            self.mapped = _mmap.mmap(self.f.fileno(), 0,
+                                     access=_mmap.ACCESS_READ)
+            self.array_reader = mapped_array_reader(self.mapped)
+        data_tags = {}
+
+        def on_tag(tag):
+            if (tag.kind != 'section' and len(tag.path) == 4 and
+                    tag.path[0] == 'ImageList' and
+                    tag.path[2:] == ('ImageData', 'Data')):
+                data_tags[tag.path[1]] = tag
+        # the pixel data is skipped, but walked past to find where it is.
+        # With mmap, other arrays are views onto the map, as for load_image
+        tag_filter = TagFilter(exclude=['ImageList/*/ImageData/Data'])
+        reader = DMTagReader(self.f, self.array_reader, tag_filter, on_tag,
+                             walk_skipped=True, stats=stats)
+        self.tags = reader.header()
+        self.version = reader.version
+        self.images = [DMImage(self, entry, data_tags.get(str(i)))
+                       for i, entry in enumerate(self.tags.get('ImageList',
+                                                               []))]
+
+    def read_image_data(self, image):
+        """Reads and decodes the pixel data of image, one of self.images"""
+        if image.data_tag is None:
+            raise ValueError("Image has no data")
+        with phase(self.stats, 'image'):
+            imdict = dict(image.tags['ImageData'],
+                          Data=image.data_tag.read(self.f, self.array_reader))
+            return imagedatadict_to_ndarray(imdict)
+
+    def close(self):
+        if self.own_file:
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def open_dm(file, mmap=False, stats=None):
+    """
+    Opens the dm3 or dm4 file-like object or path file, returning a DMFile.
+    The tags are read straight away, but image data only when the data of
+    one of the DMFile's images is first used, eg
+        with open_dm(path) as dm:
+            im = dm.images[-1].data
+    so unused images (like the thumbnail at index 0) are never read.
+    mmap and stats are as for load_image. The DMFile has to stay open until
+    all the image data wanted has been read.
+    Compressed files (see dm_compressed) are decompressed as they're read,
+    and can't be mapped, so mmap is ignored for them.
+    """
+    if isinstance(file, str):
+        f = open_dm_file(file, stats)
+        return DMFile(f, True, mmap and not isinstance(f, CompressedFile),
+                      stats)
+    f = decompressed(file, stats)
+    return DMFile(f, False, mmap and f is file, stats)
+
+def _strided(image, width):
+    # every step'th row and column of image, step making it <= width wide
+    rgb = image.dm_type == 23
+    shape = image.shape[:-1] if rgb else image.shape
+    step = max(1, -(-shape[-1] // width))
+    axes = min(2, len(shape))
+    # only the first frame of a stack
+    lead = (0,) * (len(shape) - axes)
+    if image.dm_file.mapped is not None or image.dm_type in (27, 28):
+        # a view onto the map, so only the sampled pages are touched
+        return np.ascontiguousarray(
+            image.data[lead + (slice(None, None, step),) * axes])
+    rows = image.stack()[lead + (slice(None, None, step),)]
+    return rows[:, ::step] if axes == 2 else rows
+
+def load_preview(file, width=256, mmap=True, use_thumbnail=True):
+    """
+    Returns a preview of the image load_image would return from the file
+    or path file, at most width pixels wide, by taking every n'th row and
+    column of it (and only the first frame of a stack).
+    If use_thumbnail is True and the file has a thumbnail (ImageList[0]) at
+    least width wide, that's sampled instead; DM thumbnails are usually RGB.
+    With mmap, only the pages holding the sampled pixels are read, so
+    the time taken hardly depends on the size of the image. Otherwise the
+    sampled rows are read whole, which file objects without a real file
+    behind them need.
+    """
+    with open_dm(file, mmap) as dm:
+        image = dm.images[-1]
+        if use_thumbnail and len(dm.images) > 1:
+            thumb = dm.images[0]
+            thumb_width = thumb.shape[-2 if thumb.dm_type == 23 else -1]
+            if thumb.data_tag is not None and thumb_width >= width:
+                image = thumb
+        return _strided(image, width)
+
+def load_image_stream(file, stats=None):
+    """
+    Loads the image load_image would from the file-like object file in a
+    single forward pass, without seeking, eg from a pipe or socket. Each
+    image's data is copied straight into a numpy array as it arrives.
+    """
+    buffers = {}
+
+    def on_payload(tag, offset, chunk):
+        buf = buffers.get(tag.path)
+        if buf is None:
+            buf = buffers[tag.path] = np.empty(tag.nbytes, np.uint8)
+        buf[offset:offset + len(chunk)] = np.frombuffer(chunk, np.uint8)
+    tags = stream_dm_tags(file, on_payload, stats=stats)
+    with phase(stats, 'image'):
+        imdict = tags['ImageList'][-1]['ImageData']
+        data = buffers.get(imdict['Data'].path, np.empty(0, np.uint8))
+        return imagedatadict_to_ndarray(dict(
+            imdict, Data=data.view(numpy_dtype(imdict['Data'].fmt[1:]))))
+
+def load_image(file, mmap=False, use_index=False, stats=None, roi=None,
+               bin=None):
     """
     Loads the image from the file-like object or string file.
     If file is a string, the file is opened and then read.
     Returns a numpy ndarray of our best guess for the most important image
     in the file.
+    If mmap is True, file must be backed by a real file. The tags are then
+    walked without reading the array payloads and the image is returned as
+    a read-only view onto a memory map of the file.
+    If use_index is True, file must have a name. Its TagIndex is loaded (or
+    built and saved, the first time) and only the chosen image's tags are
+    read, straight from their recorded offsets.
+    stats is an optional dm_stats.DMStats to count the work done in.
+    roi = (y0, y1, x0, x1) and bin = (by, bx) load just that region of the
+    image, binned, reading only the rows it covers (see ImageStack.region).
+    Files that can't seek, like pipes, are read with load_image_stream, and
+    then neither mmap, use_index, roi nor bin can be given.
+    gzip, bzip2 and xz compressed files are decompressed as they're read
+    (see dm_compressed). mmap is ignored for them.
     """
     if isinstance(file, str):
         with open(file, "rb") as f:
-            return load_image(f)
-    dmtag = parse_dm_header(file)
-    img_index = -1
-    return imagedatadict_to_ndarray(dmtag['ImageList'][img_index]['ImageData'])
+            return load_image(f, mmap=mmap, use_index=use_index, stats=stats,
+                              roi=roi, bin=bin)
+    whole = roi is None and bin is None
+    if not seekable(file):
+        if mmap or use_index or not whole:
+            raise ValueError("mmap, use_index, roi and bin need a file that "
+                             "can seek")
+        return load_image_stream(file, stats)
+    f = decompressed(file, stats)
+    if f is not file:
+        file, mmap = f, False
+    if not use_index:
+        # only the image we return has its data read
+        with open_dm(file, mmap, stats) as dm:
+            image = dm.images[-1]
+            return image.data if whole else image.stack().region(roi, bin)
+    if stats is not None:
+        file = stats.wrap(file)
+    mapped = array_reader = None
+    if mmap:
+        mapped = _mmap.mmap(file.fileno(), 0, access=_mmap.ACCESS_READ)
+        array_reader = mapped_array_reader(mapped)
+    with phase(stats, 'index'):
+        index = TagIndex.for_file(file.name)
+        n = len(index.find('ImageList/*')) - 1
+        image_path = 'ImageList/%d/ImageData' % n
+        if whole:
+            dmtag = index.read(file, [image_path], array_reader=array_reader)
+        else:
+            dmtag = index.read(file, [image_path], [image_path + '/Data'])
+            data_tag = index.by_path[('ImageList', str(n), 'ImageData',
+                                      'Data')]
+    if not whole:
+        image = DMImage(None, dmtag['ImageList'][-1], data_tag)
+        return ImageStack(file, data_tag.offset, image.shape, image.dm_type,
+                          mapped=mapped).region(roi, bin)
+    with phase(stats, 'image'):
+        return imagedatadict_to_ndarray(dmtag['ImageList'][-1]['ImageData'])
 
@@ -5,16 +5,57 @@ Created on Sun May 19 07:58:10 2013
 @author: matt
 """
 from __future__ import absolute_import, print_function, division
-from .parse_dm3_grammar import dm3_grammar, dict_to_dm3, dm3_to_dictionary
-from file_grammar import ParsedGrammar
+from .parse_dm3_grammar import (dm3_grammar, dict_to_dm3, dm3_to_dictionary,
+                                general_grammar, replace_map,
+                                dm3_grammar_defs, dm3_grammar_defs2,
+                                dm4_grammar_defs, sniff_dm_grammar_defs,
+                                get_grammar, grammar_cache_size,
+                                parse_dm_header)
+from .dm3_image_utils import (ndarray_to_dmdict, ndarray_to_imagedatadict,
+                              load_image, load_preview, open_dm, save_image,
+                              save_image_stream,
+                              imagedatadict_to_ndarray, unpack_packed_complex)
+from .dm_index import TagIndex, index_extension
+from .dm_tags import read_dm_tags, struct_array, numpy_dtype
+from .dm_writer import write_dm, patch_dm_tags
+from .convert_dm import convert_file, convert_files
+from . import convert_dm
+from .dm_catalog import (catalog_file, scan_catalog, write_catalog,
+                         load_catalog)
+from .dm_stats import DMStats
+from .dm_stream import stream_dm_tags
+from .dm_compressed import CompressedFile, SeekIndex, compression_format
+from . import benchmark_dm
+from .dm_view_utils import (ImageHistogram, sample_pixels, AutoContrast,
+                            ImagePyramid)
+from .dm_util import LRUCache
 import unittest
 import StringIO
+import io
 import array
+import bz2
+import gzip
+import os
+import shutil
+import tempfile
+import threading
+import numpy as np
+
+try:
+    from .dm_asynctest import dm_asynctest
+except SyntaxError:
+    # dm_async needs Python 3.7
+    pass
+
+
+def _crash(*args):
+    # stands in for convert_file in a worker process, which then dies
+    os._exit(1)
 
 
 class dm3test(unittest.TestCase):
     def setUp(self):
-        self.g = ParsedGrammar(dm3_grammar, 'header')
+        self.g = get_grammar('dm3')
 
     def check(self, data):
         # writes out data into a StringIO, reads it back in again
@@ -41,6 +82,624 @@ class dm3test(unittest.TestCase):
                   "d": array.array('I', [0] * 32)}}
         self.check(mydata)
 
+    def test_write_dm(self):
+        data = {"Bob": 45, "Joe": {"hi": [34, 56], "Nope": 56.7,
+                "d": array.array('I', [0] * 32), "s": (1, 2.5)},
+                "n": np.arange(6, dtype='>i2').reshape(2, 3)}
+        for version in (3, 4):
+            s = io.BytesIO()
+            write_dm(s, data, version)
+            s.seek(0)
+            ret = parse_dm_header(s)
+            self.assertEqual(list(ret.pop('n')), list(range(6)))
+            self.assertEqual(ret, dict((k, v) for k, v in data.items()
+                                       if k != 'n'))
+
+    def test_write_dm_uint8(self):
+        data = {"u": np.array([200, 1], np.uint8),
+                "a": array.array('B', [255, 0])}
+        for version in (3, 4):
+            s = io.BytesIO()
+            write_dm(s, data, version)
+            s.seek(0)
+            ret = read_dm_tags(s)
+            self.assertEqual(ret['u'], array.array('B', [200, 1]))
+            self.assertEqual(ret['a'], array.array('B', [255, 0]))
+
+    def test_patch_dm_tags(self):
+        data = {"Cal": [{"Scale": 1.0, "Origin": 3}, {"Scale": 2.0, "Origin": 4}],
+                "a": array.array('H', [1, 2, 3])}
+        for version in (3, 4):
+            s = io.BytesIO()
+            write_dm(s, data, version)
+            size = len(s.getvalue())
+            s.seek(0)
+            self.assertEqual(patch_dm_tags(s, {"Cal/*/Scale": 0.5,
+                                               "Cal/1/Origin": 7}), 3)
+            s.seek(0)
+            self.assertRaises(TypeError, patch_dm_tags, s, {"Cal/0/Origin": 1.5})
+            s.seek(0)
+            self.assertRaises(ValueError, patch_dm_tags, s,
+                              {"a": array.array('H', [1, 2])})
+            self.assertEqual(len(s.getvalue()), size)
+            s.seek(0)
+            self.assertEqual(parse_dm_header(s), {
+                "Cal": [{"Scale": 0.5, "Origin": 3}, {"Scale": 0.5, "Origin": 7}],
+                "a": array.array('H', [1, 2, 3])})
+
+    def test_struct_array(self):
+        data = np.zeros(4, dtype=[('f0', '<f4'), ('f1', '<f4')])
+        data['f0'] = [1, 2, 3, 4]
+        data['f1'] = [-1, -2, -3, -4]
+        s = StringIO.StringIO()
+        self.g.save(s, dict_to_dm3({'a': data}))
+        s.seek(0)
+        ret = dm3_to_dictionary(self.g.open(s))['a']
+        self.assertEqual(ret.dtype, data.dtype)
+        self.assertTrue((ret == data).all())
+        s.seek(0)
+        ret = read_dm_tags(s)['a']
+        self.assertEqual(ret.dtype, data.dtype)
+        self.assertTrue((ret == data).all())
+
+    def test_struct_array_conversion(self):
+        ret = struct_array('ff', [(1, 2), (3, 4)])
+        self.assertEqual(ret.dtype, numpy_dtype('ff'))
+        self.assertEqual(ret.tolist(), [(1, 2), (3, 4)])
+        ret = struct_array('qQ', iter([(-1, 2 ** 64 - 1)]))
+        self.assertEqual(ret.tolist(), [(-1, 2 ** 64 - 1)])
+
+    def test_dict_to_dm3_int64(self):
+        data = np.zeros(2, dtype=[('f0', np.int64), ('f1', np.uint64)])
+        header = dict_to_dm3({'s': data, 'i': np.array([-1, 2], np.int64),
+                              'u': np.array([3], np.uint64)})
+        tags = dict((t['name'], t['dataheader']['array_data'])
+                    for t in header['section']['data'])
+        self.assertEqual([t['dtype'] for t in
+                          tags['s']['struct_header']['types']], [11, 12])
+        self.assertEqual(tags['i']['arraydtype'], 11)
+        self.assertEqual(tags['i']['array'], array.array('q', [-1, 2]))
+        self.assertEqual(tags['u']['arraydtype'], 12)
+        self.assertEqual(tags['u']['array'], array.array('Q', [3]))
+
+    def test_dict_to_dm3_buffers(self):
+        header = dict_to_dm3({'b': bytearray(b'ab'),
+                              'f': np.arange(4, dtype='>f4').reshape(2, 2)})
+        tags = dict((t['name'], t['dataheader']['array_data'])
+                    for t in header['section']['data'])
+        self.assertEqual(tags['b']['arraydtype'], 10)
+        self.assertEqual(tags['b']['array'], array.array('B', [97, 98]))
+        self.assertEqual(tags['f']['arraydtype'], 6)
+        self.assertEqual(tags['f']['array'], array.array('f', range(4)))
+
+    def test_include_exclude(self):
+        data = {'a': {'b': 1, 'c': [1, 2]}, 'd': 2.5}
+        s = StringIO.StringIO()
+        self.g.save(s, dict_to_dm3(data))
+        s.seek(0)
+        self.assertEqual(dm3_to_dictionary(self.g.open(s), include=['a/b', 'd']),
+                         {'a': {'b': 1}, 'd': 2.5})
+        s.seek(0)
+        self.assertEqual(parse_dm_header(s, include=['a/b', 'd']),
+                         {'a': {'b': 1}, 'd': 2.5})
+        s.seek(0)
+        self.assertEqual(parse_dm_header(s, exclude=['a/c/*']),
+                         {'a': {'b': 1, 'c': []}, 'd': 2.5})
+
+    def test_sniff_grammar_defs(self):
+        for defs in (dm3_grammar_defs, dm3_grammar_defs2, dm4_grammar_defs):
+            g = get_grammar(replace_map(general_grammar, defs))
+            s = StringIO.StringIO()
+            g.save(s, dict_to_dm3({'a': 1}))
+            s.seek(0)
+            self.assertEqual(sniff_dm_grammar_defs(s), defs)
+            self.assertEqual(s.tell(), 0)
+
+    def test_sniff_unexpected_offset(self):
+        # trailing data gives an odd header_offset, which falls back to a
+        # known layout rather than a new grammar
+        s = io.BytesIO()
+        write_dm(s, {'a': 1}, 3)
+        s.write(b'\0' * 7)
+        s.seek(0)
+        self.assertIs(sniff_dm_grammar_defs(s), dm3_grammar_defs)
+
+    def test_grammar_cache(self):
+        self.assertIs(get_grammar('dm3'), get_grammar(dm3_grammar))
+        self.assertIsNot(get_grammar('dm3'), get_grammar('dm4'))
+        self.assertIsNot(get_grammar('dm3'), get_grammar('dm3', 'section'))
+        # each thread compiles its own
+        other = []
+        thread = threading.Thread(target=lambda: other.append(
+            get_grammar('dm3')))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other[0], get_grammar('dm3'))
+        # and only keeps the most recently used
+        g = get_grammar('dm3')
+        for i in range(grammar_cache_size):
+            get_grammar(dm3_grammar + '\n# %d' % i)
+        self.assertIsNot(get_grammar('dm3'), g)
+
+    def test_benchmark_cases(self):
+        cases = benchmark_dm.benchmark_cases('full')
+        self.assertFalse([c for c in cases if c['version'] == 3 and
+                          c['size'] > benchmark_dm.dm3_max_size])
+        self.assertTrue([c for c in cases if c['version'] == 4 and
+                         c['size'] > benchmark_dm.dm3_max_size])
+
+    def test_benchmark_errors(self):
+        def fail(case):
+            def run():
+                raise ValueError("bad case")
+            return run
+        saved = benchmark_dm.benchmarks
+        benchmark_dm.benchmarks = [('fail', fail, False),
+                                   ('write_dm', benchmark_dm._write_dm, False)]
+        try:
+            results = benchmark_dm.run_benchmarks(
+                [benchmark_dm.baseline], repeat=1, memory=False)
+        finally:
+            benchmark_dm.benchmarks = saved
+        result, = results['results']
+        self.assertIn('bad case', result['benchmarks']['fail']['error'])
+        self.assertIn('seconds', result['benchmarks']['write_dm'])
+
+
+class dm3imagetest(unittest.TestCase):
+    def setUp(self):
+        self.g = get_grammar('dm3')
+        f, self.fname = tempfile.mkstemp(suffix='.dm3')
+        os.close(f)
+
+    def tearDown(self):
+        os.remove(self.fname)
+        if os.path.exists(self.fname + index_extension):
+            os.remove(self.fname + index_extension)
+
+    def save(self, im):
+        with open(self.fname, 'wb') as f:
+            self.g.save(f, dict_to_dm3(ndarray_to_dmdict(im)))
+
+    def test_save_image(self):
+        im = np.arange(20, dtype=np.float32).reshape(4, 5)
+        for version in (3, 4):
+            save_image(self.fname, im, version)
+            self.assertTrue((load_image(self.fname) == im).all())
+
+    def test_save_image_uint8(self):
+        im = np.array([[200, 1], [0, 255]], np.uint8)
+        for version in (3, 4):
+            save_image(self.fname, im, version)
+            ret = load_image(self.fname)
+            self.assertEqual(ret.dtype, np.uint8)
+            self.assertTrue((ret == im).all())
+
+    def test_save_image_stream(self):
+        im = np.arange(60, dtype=np.uint16).reshape(3, 4, 5)
+        for version in (3, 4):
+            for shape in (im.shape, (None, 4, 5)):
+                save_image_stream(self.fname, shape, im.dtype, iter(im),
+                                  version)
+                ret = load_image(self.fname)
+                self.assertEqual(ret.shape, im.shape)
+                self.assertTrue((ret == im).all())
+        self.assertRaises(ValueError, save_image_stream, self.fname,
+                          (2, 4, 5), im.dtype, iter(im))
+
+    def test_convert_file(self):
+        im = np.arange(12, dtype=np.int32).reshape(3, 4)
+        save_image(self.fname, im)
+        out_dir = tempfile.mkdtemp()
+        path, nbytes, written, error = convert_file(self.fname, out_dir,
+                                                    ('npy', 'raw'))
+        self.assertEqual(error, None)
+        self.assertEqual(nbytes, im.nbytes)
+        self.assertTrue((np.load(written[0]) == im).all())
+        self.assertTrue((np.fromfile(written[1], im.dtype) == im.ravel()).all())
+        for f in written:
+            os.remove(f)
+        os.rmdir(out_dir)
+        with open(self.fname, 'wb') as f:
+            f.write(b'not a dm file')
+        self.assertNotEqual(convert_file(self.fname)[3], None)
+
+    def test_convert_files(self):
+        im = np.arange(12, dtype=np.int32).reshape(3, 4)
+        in_dir, out_dir = tempfile.mkdtemp(), tempfile.mkdtemp()
+        paths = [os.path.join(in_dir, 'a.dm3'), os.path.join(in_dir, 'a.dm4')]
+        for path in paths:
+            save_image(path, im)
+        results = []
+        summary = convert_files(paths, out_dir, ['npy'], 1, results.append)
+        self.assertEqual((summary['converted'], summary['failed']), (1, 1))
+        failed, = [r for r in results if r[3] is not None]
+        self.assertEqual(failed[0], paths[1])
+        self.assertIn('overwrite', failed[3])
+        # a worker dying fails its files rather than the whole batch
+        saved = convert_dm.convert_file
+        convert_dm.convert_file = _crash
+        try:
+            results = []
+            summary = convert_files(paths[:1], out_dir, ['npy'], 1,
+                                    results.append)
+        finally:
+            convert_dm.convert_file = saved
+        self.assertEqual(summary['failed'], 1)
+        self.assertEqual(results[0][0], paths[0])
+        shutil.rmtree(in_dir)
+        shutil.rmtree(out_dir)
+
+    def test_catalog_file(self):
+        im = np.arange(12, dtype=np.int32).reshape(3, 4)
+        save_image(self.fname, im, 4)
+        records = catalog_file(self.fname, ['ImageData/PixelDepth', 'Nope'])
+        self.assertEqual(len(records), 1)
+        record = records[0]
+        self.assertEqual(record['dims'], [4, 3])
+        self.assertEqual(record['dtype'], 'int32')
+        self.assertEqual(record['ImageData/PixelDepth'], 4)
+        self.assertEqual(record['Nope'], None)
+        with open(self.fname, 'rb') as f:
+            f.seek(record['data_offset'])
+            data = np.frombuffer(f.read(record['data_nbytes']), '<i4')
+        self.assertTrue((data == im.ravel()).all())
+        # unchanged files are taken from the previous records
+        previous = {self.fname: [dict(record, dtype='cached')]}
+        self.assertEqual([r['dtype'] for r in
+                          scan_catalog([self.fname], record['tags'],
+                                       previous=previous)],
+                         ['cached'])
+
+    def test_catalog_strings(self):
+        d = ndarray_to_dmdict(np.zeros((2, 2), np.int8))
+        # a bad surrogate in a string, and numbers in a uint16 array
+        d['ImageList'][0]['Name'] = np.array([0x41, 0xd800, 0x42], np.uint16)
+        d['ImageList'][0]['Counts'] = np.array([1, 0xd800], np.uint16)
+        with open(self.fname, 'wb') as f:
+            write_dm(f, d)
+        record, = catalog_file(self.fname, ['Name', 'Counts'])
+        self.assertEqual(record['Name'], u'A\ufffdB')
+        self.assertEqual(record['Counts'], [1, 0xd800])
+
+    def test_catalog_struct_array(self):
+        d = ndarray_to_dmdict(np.zeros((2, 2), np.int8))
+        cal = np.zeros(2, dtype=[('f0', '<f4'), ('f1', '<f4')])
+        cal['f0'] = 0.5
+        d['ImageList'][0]['Calibration'] = cal
+        d['ImageList'][0]['Scale'] = np.array([0.25], np.float32)
+        with open(self.fname, 'wb') as f:
+            write_dm(f, d)
+        tags = ['Calibration', 'Scale']
+        records = catalog_file(self.fname, tags)
+        self.assertEqual(records[0]['Calibration'], [[0.5, 0], [0.5, 0]])
+        self.assertEqual(records[0]['Scale'], [0.25])
+        for fmt in ('jsonl', 'csv'):
+            with open(self.fname + '.' + fmt, 'w') as out:
+                self.assertEqual(write_catalog(records, out, fmt, tags), 1)
+            loaded = load_catalog(self.fname + '.' + fmt)
+            os.remove(self.fname + '.' + fmt)
+            self.assertEqual(len(loaded[self.fname]), 1)
+        # records made with other tags are scanned again
+        previous = {self.fname: [dict(records[0], dtype='cached')]}
+        self.assertEqual([r['dtype'] for r in scan_catalog(
+            [self.fname], tags, previous=previous)], ['cached'])
+        self.assertEqual([r['dtype'] for r in scan_catalog(
+            [self.fname], ['Scale'], previous=previous)], ['int8'])
+
+    def test_stats(self):
+        im = np.arange(1000, dtype=np.float32).reshape(10, 100)
+        save_image(self.fname, im, 4)
+        stats = DMStats()
+        self.assertTrue((load_image(self.fname, mmap=True, stats=stats)
+                         == im).all())
+        d = stats.to_dict()
+        self.assertEqual(d['rules']['header']['calls'], 1)
+        # the image data is mapped, not read
+        self.assertEqual(d['rules']['array_data']['bytes_read'], 0)
+        self.assertEqual(d['bytes_read'], sum(
+            r['bytes_read'] for r in d['rules'].values()))
+        self.assertEqual(d['phases']['image']['calls'], 1)
+        stats = DMStats()
+        with open(self.fname, 'rb') as f:
+            read_dm_tags(f, stats=stats)
+        self.assertTrue(stats.rules['array_data'][2] >= im.nbytes)
+
+    def test_stats_grammar(self):
+        # the grammar path counts reads and bytes but no rules
+        im = np.arange(1000, dtype=np.float32).reshape(10, 100)
+        save_image(self.fname, im, 3)
+        stats = DMStats()
+        with open(self.fname, 'rb') as f:
+            parse_dm_header(f, stats=stats)
+        d = stats.to_dict()
+        self.assertEqual(d['rules'], {})
+        self.assertTrue(d['reads'] > 0)
+        self.assertTrue(d['bytes_read'] >= os.path.getsize(self.fname))
+        self.assertEqual(d['phases']['grammar']['calls'], 1)
+        self.assertTrue(d['phases']['grammar']['bytes_read'] > 0)
+
+    def test_open_dm(self):
+        thumb = np.arange(16, dtype=np.uint16).reshape(4, 4)
+        im = np.arange(12, dtype=np.float32).reshape(3, 4)
+        d = ndarray_to_dmdict(im)
+        d['ImageList'].insert(0, {'ImageData': ndarray_to_imagedatadict(thumb)})
+        with open(self.fname, 'wb') as f:
+            write_dm(f, d)
+        with open_dm(self.fname) as dm:
+            self.assertEqual([(i.shape, i.dtype) for i in dm.images],
+                             [(thumb.shape, thumb.dtype), (im.shape, im.dtype)])
+            self.assertFalse('Data' in dm.images[1].tags['ImageData'])
+            self.assertTrue((dm.images[1].data == im).all())
+            self.assertEqual(dm.images[0]._data, None)
+
+    def test_image_stack(self):
+        im = np.arange(4 * 5 * 6, dtype=np.uint16).reshape(4, 5, 6)
+        save_image(self.fname, im, 4)
+        with open_dm(self.fname) as dm:
+            for readahead in (0, 1000):
+                stack = dm.images[-1].stack(readahead)
+                self.assertEqual(stack.shape, im.shape)
+                for key in (2, -1, slice(1, 3), (slice(None), 2, 3),
+                            (Ellipsis, 4), (1, slice(None, None, -2), 3),
+                            Ellipsis):
+                    self.assertTrue((stack[key] == im[key]).all())
+                self.assertTrue(all((a == b).all() for a, b in zip(stack, im)))
+            self.assertRaises(IndexError, stack.__getitem__, 4)
+
+    def test_load_image_roi_bin(self):
+        im = np.arange(30 * 20, dtype=np.float32).reshape(30, 20)
+        save_image(self.fname, im)
+        for mmap in (False, True):
+            ret = load_image(self.fname, mmap=mmap, roi=(5, 15, 2, 9))
+            self.assertTrue((ret == im[5:15, 2:9]).all())
+            ret = load_image(self.fname, mmap=mmap, roi=(5, 15, 2, 9),
+                             bin=(5, 3))
+            expected = im[5:15, 2:8].reshape(2, 5, 2, 3).mean(axis=(1, 3))
+            self.assertEqual(ret.shape, (2, 2))
+            self.assertTrue(np.allclose(ret, expected))
+
+    def test_load_image_bin_complex(self):
+        im = (np.arange(6 * 4) + 1j * np.arange(6 * 4)[::-1]).astype(
+            np.complex64).reshape(6, 4)
+        d = ndarray_to_dmdict(im)
+        # DM keeps complex pixels as structs of their real and imaginary parts
+        d['ImageList'][0]['ImageData']['Data'] = im.ravel().view(
+            [('f0', '<f4'), ('f1', '<f4')])
+        with open(self.fname, 'wb') as f:
+            write_dm(f, d)
+        ret = load_image(self.fname, bin=(3, 2))
+        expected = im.reshape(2, 3, 2, 2).mean(axis=(1, 3))
+        self.assertEqual(ret.dtype, np.complex128)
+        self.assertTrue(np.allclose(ret, expected))
+
+    def test_load_preview(self):
+        im = np.arange(60 * 50, dtype=np.uint16).reshape(60, 50)
+        thumb = np.arange(30 * 30, dtype=np.float32).reshape(30, 30)
+        d = ndarray_to_dmdict(im)
+        d['ImageList'].insert(0, {'ImageData': ndarray_to_imagedatadict(thumb)})
+        with open(self.fname, 'wb') as f:
+            write_dm(f, d)
+        for mmap in (False, True):
+            preview = load_preview(self.fname, 20, mmap)
+            self.assertTrue((preview == thumb[::2, ::2]).all())
+            preview = load_preview(self.fname, 20, mmap, use_thumbnail=False)
+            self.assertTrue((preview == im[::3, ::3]).all())
+        self.assertTrue((load_preview(self.fname, 40) == im[::2, ::2]).all())
+
+    def test_load_image_stream(self):
+        class Pipe(object):
+            # can't seek, and gives short reads
+            def __init__(self, data):
+                self.f = io.BytesIO(data)
+
+            def read(self, n=-1):
+                return self.f.read(min(n, 7) if n >= 0 else n)
+
+            def seekable(self):
+                return False
+        im = np.arange(30 * 20, dtype=np.float32).reshape(30, 20)
+        for version in (3, 4):
+            b = io.BytesIO()
+            write_dm(b, ndarray_to_dmdict(im), version)
+            data = b.getvalue()
+            self.assertTrue((load_image(Pipe(data)) == im).all())
+            self.assertEqual(parse_dm_header(Pipe(data)),
+                             read_dm_tags(io.BytesIO(data)))
+            chunks = []
+            tags = stream_dm_tags(Pipe(data),
+                                  lambda tag, offset, chunk: chunks.append(
+                                      (offset, chunk)), chunk_size=1000)
+            self.assertEqual([c[0] for c in chunks], list(range(0, 2400,
+                                                                1000)))
+            self.assertEqual(b''.join(c[1] for c in chunks), im.tobytes())
+            data_tag = tags['ImageList'][0]['ImageData']['Data']
+            self.assertEqual(data_tag.nbytes, im.nbytes)
+            self.assertRaises(ValueError, load_image, Pipe(data), mmap=True)
+
+    def test_load_image_compressed(self):
+        im = np.arange(300 * 200, dtype=np.float32).reshape(300, 200)
+        save_image(self.fname, im)
+        with open(self.fname, 'rb') as f:
+            data = f.read()
+        for ext, opener in (('.gz', gzip.open), ('.bz2', bz2.BZ2File)):
+            path = self.fname + ext
+            with opener(path, 'wb') as f:
+                f.write(data)
+            try:
+                self.assertTrue((load_image(path, mmap=True) == im).all())
+                self.assertTrue((load_image(path, roi=(250, 260, 5, 9)) ==
+                                 im[250:260, 5:9]).all())
+                with open(path, 'rb') as f:
+                    self.assertEqual(
+                        parse_dm_header(f, include=['ImageList/*/ImageData/'
+                                                    'Dimensions']),
+                        {'ImageList': [{'ImageData': {'Dimensions': [200,
+                                                                     300]}}]})
+                with open(path, 'rb') as f:
+                    cf = CompressedFile(f, compression_format(f),
+                                        SeekIndex(spacing=10000))
+                    # sniffing doesn't decompress to the end to find the size
+                    self.assertIs(sniff_dm_grammar_defs(cf), dm3_grammar_defs)
+                    self.assertIsNone(cf.index.size)
+                    for pos, n in ((50000, 100), (10, 30000), (len(data) - 5,
+                                                               10)):
+                        cf.seek(pos)
+                        self.assertEqual(cf.read(n), data[pos:pos + n])
+            finally:
+                os.remove(path)
+
+    def test_load_image_mmap(self):
+        im = np.arange(12, dtype=np.float32).reshape(3, 4)
+        self.save(im)
+        ret = load_image(self.fname, mmap=True)
+        self.assertEqual(ret.shape, im.shape)
+        self.assertTrue((ret == im).all())
+
+    def test_load_image_index(self):
+        im = np.arange(12, dtype=np.int16).reshape(4, 3)
+        self.save(im)
+        for i in range(2):
+            ret = load_image(self.fname, use_index=True)
+            self.assertTrue(os.path.exists(self.fname + index_extension))
+            self.assertTrue((ret == im).all())
+        index = TagIndex.for_file(self.fname)
+        with open(self.fname, 'rb') as f:
+            dims = parse_dm_header(f, index=index,
+                                   include=['ImageList/*/ImageData/Dimensions'])
+        self.assertEqual(dims, {'ImageList': [{'ImageData': {'Dimensions': [3, 4]}}]})
+
+    def test_index_cached(self):
+        im = np.arange(12, dtype=np.int16).reshape(4, 3)
+        save_image(self.fname, im)
+        index = TagIndex.for_file(self.fname)
+        self.assertIs(TagIndex.for_file(self.fname), index)
+        found = index.find('ImageList/*/ImageData/Dimensions/1')
+        self.assertEqual([t.path for t in found],
+                         [('ImageList', '0', 'ImageData', 'Dimensions', '1')])
+        with open(self.fname, 'rb') as f:
+            full = read_dm_tags(f, include=['ImageList'])
+            self.assertEqual(index.read(f, include=['ImageList']), full)
+        # a changed file is indexed again
+        st = os.stat(self.fname)
+        os.utime(self.fname, (st.st_atime, st.st_mtime + 10))
+        self.assertIsNot(TagIndex.for_file(self.fname), index)
+
+    def test_complex_and_rgb(self):
+        data = np.zeros(6, dtype=[('f0', '<f4'), ('f1', '<f4')])
+        data['f0'] = range(6)
+        data['f1'] = 1
+        im = imagedatadict_to_ndarray(dict(Data=data, DataType=3, PixelDepth=8,
+                                           Dimensions=[3, 2]))
+        self.assertEqual(im.dtype, np.complex64)
+        self.assertEqual(im[1, 2], 5 + 1j)
+        rgb = np.array([0x04030201] * 4, dtype='<u4')
+        im = imagedatadict_to_ndarray(dict(Data=rgb, DataType=23, PixelDepth=4,
+                                           Dimensions=[2, 2]))
+        self.assertEqual(im.shape, (2, 2, 4))
+        self.assertEqual(list(im[1, 1]), [1, 2, 3, 4])
+
+    def test_unpack_packed_complex(self):
+        # a delta at the origin has a flat FFT: 1 everywhere
+        packed = np.zeros((4, 6), np.float32)
+        packed[0:3, 0:2] = 1  # columns 0 and w/2: F[0], F[h/2], Re(F[1])
+        packed[:, 2::2] = 1
+        full = unpack_packed_complex(packed)
+        self.assertTrue((full == 1).all())
+
+    def test_unpack_packed_complex_fft(self):
+        # the FFT of a random real image, packed as DM does, unpacks to
+        # np.fft.fft2's. Sizes cover odd halves (6 and 10) and h != w.
+        rng = np.random.RandomState(0)
+        for h, w in ((4, 4), (8, 6), (6, 10), (10, 4)):
+            fft = np.fft.fft2(rng.rand(h, w))
+            hh, hw = h // 2, w // 2
+            packed = np.empty((h, w))
+            packed[:, 2::2] = fft[:, 1:hw].real
+            packed[:, 3::2] = fft[:, 1:hw].imag
+            for col, kx in ((0, 0), (1, hw)):
+                packed[0, col] = fft[0, kx].real
+                packed[1, col] = fft[hh, kx].real
+                packed[2::2, col] = fft[1:hh, kx].real
+                packed[3::2, col] = fft[1:hh, kx].imag
+            full = unpack_packed_complex(packed, np.complex128)
+            self.assertTrue(np.allclose(full, fft))
+        # the packing needs even dimensions
+        for shape in ((5, 4), (4, 7)):
+            self.assertRaises(ValueError, unpack_packed_complex,
+                              np.zeros(shape))
+
+
+class dmviewtest(unittest.TestCase):
+    def test_lru_cache(self):
+        cache = LRUCache(100, sizeof=len)
+        cache.put('a', 'x' * 40)
+        cache.put('b', 'x' * 40)
+        self.assertEqual(cache.get('a'), 'x' * 40)
+        # 'b' is now the least recently used, so it makes room for 'c'
+        cache.put('c', 'x' * 40)
+        self.assertNotIn('b', cache)
+        self.assertEqual((len(cache), cache.nbytes), (2, 80))
+        # replacing a value frees the old one's bytes
+        cache.put('a', 'x' * 10)
+        self.assertEqual(cache.nbytes, 50)
+        # values bigger than the whole cache aren't kept
+        cache.put('d', 'x' * 101)
+        self.assertNotIn('d', cache)
+        self.assertEqual(cache.get('d', 'missing'), 'missing')
+        self.assertEqual(cache.nbytes, 50)
+        # get_or_put only makes a value if there's no valid one
+        self.assertEqual(cache.get_or_put('a', lambda: 'new'), 'x' * 10)
+        self.assertEqual(cache.get_or_put('a', lambda: 'new',
+                                          lambda v: len(v) > 10), 'new')
+        self.assertEqual(cache.get('a'), 'new')
+
+    def test_image_pyramid(self):
+        im = np.arange(7 * 10, dtype=np.uint16).reshape(7, 10)
+        pyramid = ImagePyramid(im)
+        self.assertIs(pyramid.level(0), im)
+        level1 = pyramid.level(1)
+        self.assertEqual(level1.shape, (3, 5))
+        expected = (im[0:6:2, 0::2] + im[1:6:2, 0::2] + im[0:6:2, 1::2] +
+                    im[1:6:2, 1::2]) / 4.0
+        self.assertTrue(np.allclose(level1, expected))
+        self.assertEqual(pyramid.level(2).shape, (1, 2))
+        self.assertTrue(np.allclose(pyramid.level(2)[0, 0],
+                                    level1[0:2, 0:2].mean()))
+        # levels stop once a side would be 0
+        self.assertEqual(pyramid.level(5).shape, (1, 2))
+
+    def test_image_histogram(self):
+        im = np.random.RandomState(0).normal(size=10000)
+        hist = ImageHistogram(im, fine_bins=100)
+        lo, hi = im.min(), im.max()
+        self.assertTrue(np.allclose(hist.histogram(100, (lo, hi)),
+                                    np.histogram(im, 100, (lo, hi))[0]))
+        # rebinned counts are close to those counted directly
+        self.assertTrue(np.allclose(hist.histogram(10, (lo, hi)),
+                                    np.histogram(im, 10, (lo, hi))[0],
+                                    atol=50))
+        self.assertAlmostEqual(hist.histogram(7, (lo, hi)).sum(), im.size)
+
+    def test_sample_pixels(self):
+        im = np.arange(1000 * 1000, dtype=np.float32).reshape(1000, 1000)
+        sample = sample_pixels(im, 10000)
+        self.assertEqual(sample.size, 10000)
+        self.assertTrue((sample == im[::10, ::10].ravel()).all())
+        self.assertEqual(sample_pixels(im[:5, :5], 100).size, 25)
+        self.assertEqual(sample_pixels(np.arange(100), 10).size, 10)
+
+    def test_auto_contrast(self):
+        im = np.tile(np.arange(1000, dtype=np.float32), (1000, 1))
+        im[0, 0] = 1e9  # a hot pixel doesn't move the limits
+        contrast = AutoContrast(im, percentiles=(1, 99), sample_size=10000)
+        lo, hi = contrast.limits
+        self.assertTrue(abs(lo - 10) < 20 and abs(hi - 990) < 20)
+        contrast.refine(im, background=False)
+        self.assertTrue(contrast.refined)
+        self.assertTrue(np.allclose(contrast.limits,
+                                    np.percentile(im, (1, 99))))
+
 
 if __name__ == "__main__":
     unittest.main()
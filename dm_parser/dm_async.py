@@ -0,0 +1,233 @@
+# asyncio versions of the blocking readers, for use from event loops.
+# Parsing and decoding run on a bounded thread pool, with a limit on how
+# many are in flight at once, so a busy loop is never blocked for a whole
+# parse and a flood of requests queues up rather than piling onto the
+# disk. Files can also come from async byte sources (anything with an
+# awaitable read(), like asyncio.StreamReader, or an async iterable of
+# bytes). Those are parsed in a single forward pass (see dm_stream) as
+# their bytes arrive, the worker thread asking the loop for each piece.
+# This module needs Python 3.7 or later, so it isn't imported by the
+# package itself.
+import asyncio
+import concurrent.futures
+import inspect
+import os
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from .parse_dm3_grammar import parse_dm_header
+from .dm3_image_utils import load_image
+from .dm_catalog import catalog_records
+from .convert_dm import find_dm_files
+
+# how much to ask an async byte source for at a time
+read_size = 1 << 20
+
+
+def is_async_source(source):
+    """True if source is an async byte source rather than a path or file"""
+    return hasattr(source, '__aiter__') or (
+        hasattr(source, 'read') and inspect.iscoroutinefunction(source.read))
+
+
+async def _next_chunk(iterator):
+    try:
+        return await iterator.__anext__()
+    except StopAsyncIteration:
+        return b''
+
+
+class AsyncSourceFile(object):
+    """
+    A file-like object that can't seek, for reading the async byte source
+    source from a thread other than the one running loop. Each read waits
+    for the source on loop. Once closed, reads raise ValueError, and a read
+    waiting for the source is cancelled.
+    """
+    def __init__(self, source, loop):
+        self.source = source
+        self.loop = loop
+        self.iterator = None
+        if not (hasattr(source, 'read') and
+                inspect.iscoroutinefunction(source.read)):
+            self.iterator = source.__aiter__()
+        self.buf = b''
+        self.closed = False
+        self.pending = None
+
+    def _next(self, n):
+        if self.closed:
+            raise ValueError("Read from a closed async source")
+        coro = (self.source.read(n) if self.iterator is None
+                else _next_chunk(self.iterator))
+        self.pending = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            return self.pending.result()
+        except concurrent.futures.CancelledError:
+            raise ValueError("Read from a closed async source")
+        finally:
+            self.pending = None
+
+    def read(self, n=-1):
+        chunks = [self.buf]
+        have = len(self.buf)
+        while n < 0 or have < n:
+            chunk = self._next(read_size if n < 0 else n - have)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            have += len(chunk)
+        data = b''.join(chunks)
+        if 0 <= n < len(data):
+            data, self.buf = data[:n], data[n:]
+        else:
+            self.buf = b''
+        return data
+
+    def seekable(self):
+        return False
+
+    def close(self):
+        self.closed = True
+        pending = self.pending
+        if pending is not None:
+            pending.cancel()
+
+
+class DMAsyncLoader(object):
+    """
+    Runs the blocking readers for coroutines: on a pool of max_workers
+    threads, with at most max_concurrency of them running or waiting for
+    a thread at once (by default, max_workers). Others wait their turn on
+    the loop.
+    Cancelling a coroutine that's still waiting means it never runs. Once
+    it's running on a thread, the read of a path or file carries on, but
+    its result is thrown away; that of an async byte source stops at its
+    next read.
+    """
+    def __init__(self, max_workers=4, max_concurrency=None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.max_concurrency = max_concurrency or max_workers
+        # asyncio primitives belong to a loop, so there's one per loop
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def _semaphore(self):
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(
+                self.max_concurrency)
+        return semaphore
+
+    async def run(self, func, *args):
+        """Runs func(*args) on the pool, within the concurrency limit"""
+        async with self._semaphore():
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, func, *args)
+
+    async def _call(self, func, source, kwargs):
+        if not is_async_source(source):
+            return await self.run(lambda: func(source, **kwargs))
+        # func sees a file that can't seek, so reads it in one pass
+        f = AsyncSourceFile(source, asyncio.get_running_loop())
+        try:
+            return await self.run(lambda: func(f, **kwargs))
+        finally:
+            # stops the thread if we're cancelled while it's reading
+            f.close()
+
+    async def load_image(self, source, **kwargs):
+        """
+        load_image for a path, file-like object or async byte source.
+        kwargs are passed on to load_image; mmap, use_index, roi and bin
+        need a path or real file.
+        """
+        return await self._call(load_image, source, kwargs)
+
+    async def parse_dm_header(self, source, **kwargs):
+        """
+        parse_dm_header for a path, file-like object or async byte source.
+        kwargs, eg include, are passed on to parse_dm_header.
+        """
+        if isinstance(source, (str, os.PathLike)):
+            return await self.run(_parse_path, source, kwargs)
+        return await self._call(parse_dm_header, source, kwargs)
+
+    async def scan_catalog(self, inputs, tags=(), recursive=False,
+                           previous=None, errors=None):
+        """
+        An async generator of the catalog records (see dm_catalog) for the
+        dm3/dm4 files found in inputs (as for find_dm_files), yielding each
+        file's records as soon as it's been read, so in no fixed order.
+        Files that can't be read are left out, with (path, exception)
+        appended to errors if it's given. Closing the generator early
+        cancels the files still to be read.
+        """
+        paths = await self.run(find_dm_files, inputs, recursive)
+        pending = set()
+        paths = iter(paths)
+        try:
+            while True:
+                # keep just enough files queued to fill the pool
+                for path in paths:
+                    pending.add(asyncio.ensure_future(self._catalog(
+                        path, tags, previous)))
+                    if len(pending) >= self.max_concurrency:
+                        break
+                if not pending:
+                    return
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    path, records, error = task.result()
+                    if error is not None and errors is not None:
+                        errors.append((path, error))
+                    for record in records:
+                        yield record
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _catalog(self, path, tags, previous):
+        try:
+            return path, await self.run(catalog_records, path, tags,
+                                        previous), None
+        except Exception as e:
+            return path, [], e
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+def _parse_path(path, kwargs):
+    with open(path, 'rb') as f:
+        return parse_dm_header(f, **kwargs)
+
+
+_default_loader = None
+
+
+def default_loader():
+    """The DMAsyncLoader the module level functions use by default"""
+    global _default_loader
+    if _default_loader is None:
+        _default_loader = DMAsyncLoader()
+    return _default_loader
+
+
+async def load_image_async(source, loader=None, **kwargs):
+    """DMAsyncLoader.load_image on loader, by default default_loader()"""
+    return await (loader or default_loader()).load_image(source, **kwargs)
+
+
+async def parse_dm_header_async(source, loader=None, **kwargs):
+    """DMAsyncLoader.parse_dm_header on loader, by default default_loader()"""
+    return await (loader or default_loader()).parse_dm_header(source,
+                                                              **kwargs)
+
+
+def scan_catalog_async(inputs, tags=(), recursive=False, previous=None,
+                       errors=None, loader=None):
+    """DMAsyncLoader.scan_catalog on loader, by default default_loader()"""
+    return (loader or default_loader()).scan_catalog(
+        inputs, tags, recursive, previous, errors)
@@ -0,0 +1,89 @@
+# Tests for dm_async, kept apart from dm3parsertest as they need Python 3.7
+from __future__ import absolute_import, print_function, division
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from .dm3_image_utils import save_image
+from .dm_async import (DMAsyncLoader, load_image_async,
+                       parse_dm_header_async, scan_catalog_async)
+
+
+async def _chunks(data, size=7):
+    for i in range(0, len(data), size):
+        await asyncio.sleep(0)
+        yield data[i:i + size]
+
+
+def _stream_reader(data, eof=True):
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    if eof:
+        reader.feed_eof()
+    return reader
+
+
+class dm_asynctest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.im = np.arange(30 * 20, dtype=np.float32).reshape(30, 20)
+        self.fname = os.path.join(self.dir, 'a.dm4')
+        save_image(self.fname, self.im, 4)
+        with open(self.fname, 'rb') as f:
+            self.data = f.read()
+        self.loader = DMAsyncLoader(max_workers=1)
+
+    def tearDown(self):
+        self.loader.close()
+        shutil.rmtree(self.dir)
+
+    def test_load_image(self):
+        async def run():
+            return [await load_image_async(self.fname, self.loader),
+                    await self.loader.load_image(self.fname, roi=(5, 9, 2, 4)),
+                    await self.loader.load_image(_stream_reader(self.data)),
+                    await self.loader.load_image(_chunks(self.data))]
+        whole, roi, stream, chunks = asyncio.run(run())
+        self.assertTrue((whole == self.im).all())
+        self.assertTrue((roi == self.im[5:9, 2:4]).all())
+        self.assertTrue((stream == self.im).all())
+        self.assertTrue((chunks == self.im).all())
+
+    def test_parse_dm_header(self):
+        include = ['ImageList/*/ImageData/Dimensions']
+        expected = {'ImageList': [{'ImageData': {'Dimensions': [20, 30]}}]}
+        for source in (self.fname, _chunks(self.data)):
+            self.assertEqual(asyncio.run(parse_dm_header_async(
+                source, self.loader, include=include)), expected)
+
+    def test_scan_catalog(self):
+        save_image(os.path.join(self.dir, 'b.dm3'), self.im[:2], 3)
+        with open(os.path.join(self.dir, 'c.dm3'), 'wb') as f:
+            f.write(b'not a dm file')
+
+        async def run(errors):
+            return [r async for r in scan_catalog_async(
+                [self.dir], errors=errors, loader=self.loader)]
+        errors = []
+        records = asyncio.run(run(errors))
+        self.assertEqual(sorted((os.path.basename(r['file']), r['dims'])
+                                for r in records),
+                         [('a.dm4', [20, 30]), ('b.dm3', [20, 2])])
+        self.assertEqual([os.path.basename(e[0]) for e in errors], ['c.dm3'])
+
+    def test_cancel(self):
+        async def run():
+            # the source never ends, so the read waits until cancelled
+            task = asyncio.ensure_future(self.loader.load_image(
+                _stream_reader(self.data[:100], eof=False)))
+            await asyncio.sleep(0.1)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            # the only worker thread has been let go
+            return await asyncio.wait_for(
+                self.loader.load_image(self.fname), 5)
+        self.assertTrue((asyncio.run(run()) == self.im).all())
@@ -0,0 +1,284 @@
+# Builds an inventory of the images in a tree of dm3/dm4 files.
+# Only the tag structure leading to each image's metadata is walked (see
+# find_dm_tags), so no pixel data is ever read, and files are scanned on a
+# pool of threads as most of the time goes on waiting for the disk.
+# Records are written one per image as JSON lines or CSV. A previous
+# catalog can be passed back in, and files whose size and mtime haven't
+# changed since are then copied over from it instead of being scanned again,
+# as long as it was made with the same tags.
+from __future__ import absolute_import, print_function, division
+import argparse
+import csv
+import json
+import logging
+import os
+import struct
+import sys
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .dm_tags import TagFilter, find_dm_tags, dm_len_types
+from .dm3_image_utils import dm_image_dtypes
+from .convert_dm import find_dm_files
+from .dm_compressed import open_dm_file
+
+catalog_formats = ('jsonl', 'csv')
+
+# the fields every record has, in output order. Selected tags follow these.
+# tags is the list of tag patterns the record was made with.
+catalog_fields = ('file', 'image', 'file_size', 'mtime', 'version', 'dims',
+                  'data_type', 'pixel_depth', 'dtype', 'data_offset',
+                  'data_nbytes', 'tags')
+
+# the ImageData tags every record is made from
+_image_tags = ('Data', 'DataType', 'PixelDepth', 'Dimensions/*')
+
+# the names of the tags DM keeps strings in, as arrays of UTF-16 code
+# units. uint16 arrays with other names are left as lists of numbers.
+string_tag_names = set(['Name', 'Units', 'Operator', 'Specimen',
+                        'Microscope', 'Operation Mode', 'Illumination Mode',
+                        'Imaging Mode', 'Acquisition Mode', 'Signal',
+                        'Label', 'Title', 'Description', 'Notes'])
+
+
+def _tag_value(f, tag):
+    # the value of tag, as python types that can be written as JSON
+    value = tag.read(f)
+    if tag.kind in ('array', 'structarray'):
+        # numpy arrays (and array.arrays) give lists of python numbers, or
+        # of tuples for structs
+        value = value.tolist() if hasattr(value, 'tolist') else list(value)
+    if tag.kind == 'array':
+        if tag.arraydtype == 4 and tag.path[-1] in string_tag_names:
+            return struct.pack('<%dH' % len(value), *value).decode(
+                'utf-16-le', 'replace')
+        return value
+    if tag.kind == 'structarray':
+        return [list(x) for x in value]
+    return list(value) if tag.kind == 'struct' else value
+
+
+def catalog_file(path, tags=()):
+    """
+    Returns a record (an OrderedDict with catalog_fields) for each image in
+    the ImageList of the dm3/dm4 file at path. dims are the image's
+    Dimensions (in DM's x, y, ... order), dtype the name of its DataType
+    and data_offset and data_nbytes give the span of its pixel data in the
+    file.
+    tags are tag path patterns (see TagFilter) relative to an ImageList
+    entry, eg 'ImageTags/Microscope Info/Voltage', naming extra data tags to
+    put in each record. Each record holds the value of a tag under its
+    pattern, or for patterns with wildcards a dictionary of every matching
+    tag's value keyed by its path. Patterns that match nothing give None.
+    Arrays are given as lists, except for those of the tags in
+    string_tag_names, which are given as text.
+    """
+    st = os.stat(path)
+    patterns = (['ImageList/*/ImageData/' + t for t in _image_tags] +
+                ['ImageList/*/' + t for t in tags])
+    with open_dm_file(path) as f:
+        version, = struct.unpack('>l', f.read(4))
+        if version not in dm_len_types:
+            raise ValueError("%s is neither a dm3 nor dm4 file!" % path)
+        f.seek(0)
+        found = find_dm_tags(f, patterns)
+        images = OrderedDict()
+        for tag in found:
+            image = images.setdefault(int(tag.path[1]), {})
+            name = '/'.join(tag.path[2:])
+            if name == 'ImageData/Data':
+                image[name] = tag
+            else:
+                image[name] = _tag_value(f, tag)
+    records = []
+    for i, values in images.items():
+        data = values.get('ImageData/Data')
+        data_type = values.get('ImageData/DataType')
+        record = OrderedDict([
+            ('file', path),
+            ('image', i),
+            ('file_size', st.st_size),
+            ('mtime', st.st_mtime),
+            ('version', version),
+            ('dims', [v for k, v in sorted(
+                (int(k.rsplit('/', 1)[1]), v) for k, v in values.items()
+                if k.startswith('ImageData/Dimensions/'))]),
+            ('data_type', data_type),
+            ('pixel_depth', values.get('ImageData/PixelDepth')),
+            ('dtype', dm_image_dtypes.get(data_type, (None,))[0]),
+            ('data_offset', data.offset if data else None),
+            ('data_nbytes', data.nbytes if data else None),
+            ('tags', list(tags))])
+        for t in tags:
+            if any(c in t for c in '*?['):
+                tag_filter = TagFilter(include=[t])
+                record[t] = OrderedDict(
+                    (k, v) for k, v in values.items()
+                    if tag_filter.names(tuple(k.split('/')))) or None
+            else:
+                record[t] = values.get(t.strip('/'))
+        records.append(record)
+    return records
+
+
+def load_catalog(path):
+    """
+    Reads the records from a catalog written by write_catalog, returning a
+    dictionary of the list of records for each file. CSV catalogs give the
+    values back as strings.
+    """
+    ret = OrderedDict()
+    with open(path, 'r') as f:
+        if path.endswith('.csv'):
+            records = csv.DictReader(f)
+        else:
+            records = (json.loads(line, object_pairs_hook=OrderedDict)
+                       for line in f if line.strip())
+        for record in records:
+            ret.setdefault(record['file'], []).append(record)
+    return ret
+
+
+def _unchanged(path, records, tags):
+    # true if the file at path looks like the one records were made from,
+    # and they were made with the same tag patterns
+    st = os.stat(path)
+    try:
+        old_tags = records[0]['tags']
+        if not isinstance(old_tags, list):
+            # CSV catalogs hold it as JSON
+            old_tags = json.loads(old_tags)
+        return (int(records[0]['file_size']) == st.st_size and
+                float(records[0]['mtime']) == st.st_mtime and
+                old_tags == list(tags))
+    except (KeyError, TypeError, ValueError):
+        return False
+
+
+def catalog_records(path, tags=(), previous=None):
+    """
+    Returns the records for the file at path, taken from previous (as for
+    scan_catalog) if it hasn't changed since and they were made with the
+    same tags, otherwise from catalog_file.
+    """
+    if (previous and path in previous and
+            _unchanged(path, previous[path], tags)):
+        return previous[path]
+    return catalog_file(path, tags)
+
+
+def scan_catalog(paths, tags=(), previous=None, workers=8, errors=None):
+    """
+    Yields the records (see catalog_file) for every image in the files
+    paths, in order, scanning workers files at a time on a thread pool.
+    previous is an optional dictionary of earlier records by file, as
+    load_catalog returns. Those of files that haven't changed since, and
+    were cataloged with the same tags, are yielded again without the file
+    being read.
+    Files that can't be read are logged and left out. If errors is given,
+    (path, exception) is appended to it for each of them.
+    """
+    def scan(path):
+        try:
+            return catalog_records(path, tags, previous), None
+        except Exception as e:
+            return [], e
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for path, (records, error) in zip(paths, pool.map(scan, paths)):
+            if error is not None:
+                logging.warning("Could not catalog %s: %s", path, error)
+                if errors is not None:
+                    errors.append((path, error))
+            for record in records:
+                yield record
+
+
+class CatalogWriter(object):
+    """
+    Writes records to the open text file out, in the format fmt, one of
+    catalog_formats. tags are the tag patterns the records were made with,
+    which CSV needs up front for its columns.
+    Values that aren't numbers or strings are written to CSV as JSON.
+    """
+    def __init__(self, out, fmt='jsonl', tags=()):
+        if fmt not in catalog_formats:
+            raise ValueError("Unknown catalog format %r" % fmt)
+        self.out = out
+        self.fmt = fmt
+        if fmt == 'csv':
+            self.csv = csv.DictWriter(out, list(catalog_fields) + list(tags),
+                                      extrasaction='ignore')
+            self.csv.writeheader()
+
+    def write(self, record):
+        if self.fmt == 'jsonl':
+            self.out.write(json.dumps(record) + '\n')
+        else:
+            self.csv.writerow(dict(
+                (k, json.dumps(v) if isinstance(v, (list, dict)) else v)
+                for k, v in record.items()))
+
+
+def write_catalog(records, out, fmt='jsonl', tags=()):
+    """
+    Writes the iterable of records to the open text file out as they
+    arrive (see CatalogWriter). Returns the number of records written.
+    """
+    writer = CatalogWriter(out, fmt, tags)
+    n = 0
+    for record in records:
+        writer.write(record)
+        n += 1
+    return n
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Catalog the images in dm3/dm4 files without reading "
+                    "their pixel data")
+    parser.add_argument('inputs', nargs='+',
+                        help="files, directories or glob patterns")
+    parser.add_argument('-o', '--output',
+                        help="the catalog file to write (default: stdout)")
+    parser.add_argument('-f', '--format', choices=catalog_formats,
+                        help="output format (default: from the output's "
+                             "extension, else jsonl)")
+    parser.add_argument('-t', '--tag', action='append', dest='tags',
+                        default=[],
+                        help="an extra tag path to record, relative to each "
+                             "ImageList entry, can be given more than once")
+    parser.add_argument('-j', '--workers', type=int, default=8,
+                        help="number of threads (default: 8)")
+    parser.add_argument('-r', '--recursive', action='store_true',
+                        help="search directories recursively")
+    parser.add_argument('-u', '--update', action='store_true',
+                        help="reuse the records in an existing output for "
+                             "files that haven't changed, if they were made "
+                             "with the same tags")
+    args = parser.parse_args(argv)
+    logging.basicConfig()
+    fmt = args.format
+    if fmt is None:
+        fmt = ('csv' if args.output and args.output.endswith('.csv')
+               else 'jsonl')
+    previous = None
+    if args.update and args.output and os.path.exists(args.output):
+        previous = load_catalog(args.output)
+
+    paths = find_dm_files(args.inputs, args.recursive)
+    errors = []
+    records = scan_catalog(paths, args.tags, previous, args.workers, errors)
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        n = write_catalog(records, out, fmt, args.tags)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print("%d images in %d files, %d failed" % (n, len(paths), len(errors)),
+          file=sys.stderr)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,352 @@
+# Transparent reading of gzip, bzip2 and xz compressed dm3/dm4 files.
+# A CompressedFile decompresses on the fly and can seek, so the tag walker,
+# the grammar and ImageStack all read it like a plain file. Seeking
+# backwards, or forwards a long way, restarts decompression from the
+# nearest seek point before the target rather than from the start of the
+# file. Seek points are recorded as decompression passes them and are
+# kept in a SeekIndex, cached per file for the life of the process, so
+# later reads of the same file (eg a second ROI or frame) only decompress
+# from the nearest point.
+# For gzip, a seek point is a copy of the decompressor's state, taken every
+# spacing bytes of output. bzip2 and xz decompressors can't be copied, so
+# their only seek points are the starts of streams, eg those written by
+# pbzip2, or xz -T with a small block size.
+# The time spent decompressing and the compressed bytes read are counted in
+# the 'decompress' phase of a DMStats.
+from __future__ import absolute_import, print_function, division
+import bisect
+import os
+import threading
+import zlib
+
+from .dm_stats import phase
+from .dm_util import LRUCache, ReadIntoMixin
+
+try:
+    import bz2
+except ImportError:
+    bz2 = None
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+# the bytes each format starts with
+compression_magic = (('gzip', b'\x1f\x8b'),
+                     ('bz2', b'BZh'),
+                     ('xz', b'\xfd7zXZ\x00'))
+
+compressed_extensions = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'xz'}
+
+# decompressed bytes between gzip seek points. Each point holds a copy of
+# the decompressor, about 40kB.
+default_spacing = 4 << 20
+
+# compressed bytes read at a time
+read_size = 64 << 10
+
+# decompressed bytes buffered for small reads
+buffer_size = 64 << 10
+
+# decompressed bytes thrown away at a time when skipping forwards
+discard_size = 1 << 20
+
+# how many files' SeekIndex seek_index keeps
+index_cache_size = 32
+
+
+def strip_compressed_extension(path):
+    """Returns path without its compression extension, if it has one"""
+    base, ext = os.path.splitext(path)
+    return base if ext.lower() in compressed_extensions else path
+
+
+def compression_format(f):
+    """
+    Returns the compression format ('gzip', 'bz2' or 'xz') of the seekable
+    file-like object f from its first bytes, or None if it isn't
+    compressed. f is left where it was.
+    """
+    pos = f.tell()
+    magic = f.read(6)
+    f.seek(pos)
+    for fmt, m in compression_magic:
+        if magic.startswith(m):
+            return fmt
+    return None
+
+
+class _Decoder(object):
+    # a decompressor for one gzip member, bz2 or xz stream, with the same
+    # interface for each. state is a copy of a gzip decompressor to carry
+    # on from.
+    def __init__(self, fmt, state=None):
+        self.fmt = fmt
+        self.tail = b''
+        if state is not None:
+            self.d = state.copy()
+        elif fmt == 'gzip':
+            self.d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif fmt == 'bz2' and bz2 is not None:
+            self.d = bz2.BZ2Decompressor()
+        elif fmt == 'xz' and lzma is not None:
+            self.d = lzma.LZMADecompressor(lzma.FORMAT_XZ)
+        else:
+            raise ValueError("Can't decompress %s files without the %s "
+                             "module" % (fmt, {'xz': 'lzma'}.get(fmt, fmt)))
+
+    @property
+    def eof(self):
+        return self.d.eof
+
+    @property
+    def unused_data(self):
+        return self.d.unused_data
+
+    @property
+    def needs_input(self):
+        if self.fmt == 'gzip':
+            return not self.tail
+        return self.d.needs_input
+
+    def decompress(self, data, max_length):
+        if self.fmt != 'gzip':
+            return self.d.decompress(data, max_length)
+        out = self.d.decompress(self.tail + data if self.tail else data,
+                                max_length)
+        self.tail = self.d.unconsumed_tail
+        return out
+
+    def state(self):
+        """A copy to restart from, or None if the format can't copy"""
+        return self.d.copy() if self.fmt == 'gzip' else None
+
+
+class SeekIndex(object):
+    """
+    The seek points of a compressed file found so far: offsets are their
+    decompressed offsets, in order, and points (compressed offset, state)
+    for each, where state is a decompressor to copy or None for the start
+    of a stream. size is the decompressed size, once it's known.
+    A SeekIndex can be shared by CompressedFiles reading the same file from
+    different threads.
+    """
+    def __init__(self, start=0, spacing=default_spacing):
+        self.spacing = spacing
+        self.offsets = [0]
+        self.points = [(start, None)]
+        self.size = None
+        self.lock = threading.Lock()
+
+    def add(self, offset, in_offset, state):
+        with self.lock:
+            # points are found in order, so anything else is known already
+            if offset > self.offsets[-1]:
+                self.offsets.append(offset)
+                self.points.append((in_offset, state))
+
+    def point(self, offset):
+        """Returns (offset, in_offset, state) of the last point <= offset"""
+        with self.lock:
+            i = bisect.bisect_right(self.offsets, offset) - 1
+            return (self.offsets[i],) + self.points[i]
+
+    def next_offset(self, offset):
+        """The offset of the next periodic seek point after offset"""
+        return (offset // self.spacing + 1) * self.spacing
+
+
+_index_cache = LRUCache(index_cache_size, sizeof=lambda v: 1)
+
+
+def seek_index(path):
+    """
+    Returns the SeekIndex for the compressed file at path, shared with
+    every other CompressedFile opened on it while it's unchanged. The
+    index_cache_size most recently used are kept.
+    """
+    st = os.stat(path)
+    return _index_cache.get_or_put(
+        os.path.abspath(path),
+        lambda: (st.st_size, st.st_mtime, SeekIndex()),
+        lambda v: v[:2] == (st.st_size, st.st_mtime))[2]
+
+
+class CompressedFile(ReadIntoMixin):
+    """
+    A read-only, seekable file-like object giving the decompressed contents
+    of the compressed file-like object f, which must be able to seek.
+    fmt is one of the values of compressed_extensions. index is a SeekIndex
+    to use and add to, by default a new one starting where f is.
+    If stats (a dm_stats.DMStats) is given, reads of f are counted in it,
+    and decompression in its 'decompress' phase. f is closed by close() if
+    own_file is True.
+    """
+    def __init__(self, f, fmt, index=None, stats=None, own_file=False):
+        self.raw = f if stats is None else stats.wrap(f)
+        self.fmt = fmt
+        self.index = index if index is not None else SeekIndex(f.tell())
+        self.stats = stats
+        self.own_file = own_file
+        self.name = getattr(f, 'name', None)
+        self.pos = 0
+        self._restore(0)
+
+    def _restore(self, offset):
+        # restarts decompression from the last seek point <= offset
+        out_offset, in_offset, state = self.index.point(offset)
+        self.raw.seek(in_offset)
+        self._in_pos = in_offset
+        self._decoder = _Decoder(self.fmt, state)
+        self._buf = b''
+        self._buf_pos = out_offset
+
+    def _decode(self, max_length):
+        # decompresses up to max_length more bytes, stopping at the next
+        # seek point. Returns b'' at the end of the file.
+        index = self.index
+        d = self._decoder
+        out_pos = self._buf_pos + len(self._buf)
+        while True:
+            data = b''
+            if d.eof:
+                data = d.unused_data
+                if not data:
+                    data = self.raw.read(read_size)
+                    self._in_pos += len(data)
+                if not data:
+                    index.size = out_pos
+                    return b''
+                # another stream (or gzip member) follows
+                index.add(out_pos, self._in_pos - len(data), None)
+                d = self._decoder = _Decoder(self.fmt)
+            elif d.needs_input:
+                data = self.raw.read(read_size)
+                self._in_pos += len(data)
+                if not data:
+                    # there may still be output held in the decompressor
+                    data = None
+            next_offset = index.next_offset(out_pos)
+            out = d.decompress(data or b'', min(max_length,
+                                                next_offset - out_pos))
+            if out:
+                if out_pos + len(out) == next_offset:
+                    state = d.state()
+                    if state is not None:
+                        index.add(next_offset, self._in_pos - len(d.tail),
+                                  state)
+                return out
+            if data is None and not d.eof:
+                raise ValueError("Compressed file %s ends early" % self.name)
+
+    def _advance(self, max_length):
+        # decompresses the next piece into _buf, see _decode
+        out = self._decode(max_length)
+        if out:
+            self._buf_pos += len(self._buf)
+            self._buf = out
+        return out
+
+    def _seek_decoder(self, pos):
+        # leaves _buf holding the decompressed bytes from pos, if any
+        out_pos = self._buf_pos + len(self._buf)
+        if pos < self._buf_pos or self.index.point(pos)[0] > out_pos:
+            self._restore(pos)
+            out_pos = self._buf_pos
+        while out_pos <= pos:
+            out = self._advance(min(max(pos - out_pos, buffer_size),
+                                    discard_size))
+            if not out:
+                break
+            out_pos += len(out)
+
+    def _read(self, n):
+        self._seek_decoder(self.pos)
+        start = min(self.pos - self._buf_pos, len(self._buf))
+        if 0 <= n <= len(self._buf) - start:
+            data = self._buf[start:start + n]
+        else:
+            chunks = [self._buf[start:]]
+            have = len(chunks[0])
+            while n < 0 or have < n:
+                out = self._advance(discard_size if n < 0
+                                    else max(n - have, buffer_size))
+                if not out:
+                    break
+                if n >= 0 and have + len(out) > n:
+                    out = out[:n - have]
+                chunks.append(out)
+                have += len(out)
+            data = b''.join(chunks)
+        self.pos += len(data)
+        return data
+
+    def read(self, n=-1):
+        with phase(self.stats, 'decompress'):
+            return self._read(-1 if n is None else n)
+
+    def size(self):
+        """The decompressed size, which is found by decompressing to the end"""
+        if self.index.size is None:
+            with phase(self.stats, 'decompress'):
+                # carry on from the last seek point, or from here if later
+                self._seek_decoder(max(self.index.offsets[-1],
+                                       self._buf_pos + len(self._buf)))
+                while self._advance(discard_size):
+                    pass
+        return self.index.size
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.size()
+        if offset < 0:
+            raise ValueError("Negative seek position %d" % offset)
+        self.pos = offset
+        return offset
+
+    def tell(self):
+        return self.pos
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def close(self):
+        if self.own_file:
+            self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+def decompressed(f, stats=None, own_file=False):
+    """
+    Returns the seekable file-like object f or, if it's compressed, a
+    CompressedFile reading it. Files with a path share a cached SeekIndex
+    (see seek_index). stats and own_file are as for CompressedFile.
+    """
+    fmt = compression_format(f)
+    if fmt is None:
+        return f
+    name = getattr(f, 'name', None)
+    index = None
+    if isinstance(name, str) and os.path.isfile(name) and f.tell() == 0:
+        index = seek_index(name)
+    return CompressedFile(f, fmt, index, stats, own_file)
+
+
+def open_dm_file(path, stats=None):
+    """
+    Opens the file at path for reading, decompressing it on the fly if it's
+    compressed (see decompressed).
+    """
+    return decompressed(open(path, 'rb'), stats, own_file=True)
@@ -0,0 +1,198 @@
+# A persistent index of where every tag lives in a dm3 or dm4 file.
+# Building the index walks the tag structure once without reading any data.
+# It's then saved next to the file (or anywhere else) so later reads can
+# seek straight to the tags they want instead of walking the file again.
+# The index is only trusted while the file's size and mtime match those
+# recorded when it was built. Loaded indexes are also kept for the life of
+# the process, so repeated reads of a file don't parse its index again.
+from __future__ import absolute_import, print_function, division
+import json
+import logging
+import os
+from fnmatch import fnmatchcase
+
+from .dm_tags import TagFilter, TagInfo, scan_dm_tags
+from .dm_compressed import open_dm_file
+from .dm_util import LRUCache
+
+# bump this if the saved layout changes, older index files are then rebuilt
+index_format = 1
+index_extension = '.dmidx'
+
+# the order TagInfo fields are stored in for each tag of a saved index
+_fields = ('kind', 'dtype', 'arraydtype', 'fmt', 'count', 'offset', 'nbytes',
+           'is_dict')
+
+# how many files' TagIndex for_file keeps loaded
+index_cache_size = 32
+
+_index_cache = LRUCache(index_cache_size, sizeof=lambda v: 1)
+
+
+def _has_wildcard(name):
+    return any(c in name for c in '*?[')
+
+
+class TagIndex(object):
+    """
+    Maps every tag path in a file to a TagInfo describing its location,
+    DM type and size. tags is the list of TagInfo in file order.
+    size and mtime identify the file the index was built from.
+    """
+    def __init__(self, version, tags, size=None, mtime=None):
+        self.version = version
+        self.tags = tags
+        self.size = size
+        self.mtime = mtime
+        self.by_path = dict((t.path, t) for t in tags)
+        # where each tag is in tags, and the paths of each section's tags
+        self.position = dict((t.path, i) for i, t in enumerate(tags))
+        self.children = {(): []}
+        for t in tags:
+            if t.kind == 'section':
+                self.children[t.path] = []
+            self.children[t.path[:-1]].append(t.path)
+
+    @classmethod
+    def build(cls, f):
+        """Builds the index for the open file f"""
+        version, tags = scan_dm_tags(f)
+        size = mtime = None
+        if hasattr(f, 'fileno'):
+            st = os.fstat(f.fileno())
+            size, mtime = st.st_size, st.st_mtime
+        return cls(version, tags, size, mtime)
+
+    @classmethod
+    def for_file(cls, path, index_path=None, save=True):
+        """
+        Returns the index for the file at path, loading it from index_path
+        (by default path with index_extension added) if that's still valid,
+        otherwise building it again and, if save is True, saving it there.
+        The index_cache_size most recently used indexes are kept loaded and
+        are returned again while their file is unchanged.
+        """
+        index_path = index_path or path + index_extension
+        key = os.path.abspath(path), os.path.abspath(index_path)
+        index = _index_cache.get(key)
+        if index is None or not index.matches(path):
+            # loaded outside the cache's lock, as building can take a while
+            index = cls._load_or_build(path, index_path, save)
+            _index_cache.put(key, index)
+        return index
+
+    @classmethod
+    def _load_or_build(cls, path, index_path, save):
+        if os.path.exists(index_path):
+            try:
+                index = cls.load(index_path)
+            except (IOError, ValueError, KeyError, TypeError):
+                logging.warning("Ignoring unreadable index %s", index_path)
+            else:
+                if index.matches(path):
+                    return index
+        with open_dm_file(path) as f:
+            index = cls.build(f)
+        if index.size is None:
+            # build can't stat a compressed file through its decompressor
+            st = os.stat(path)
+            index.size, index.mtime = st.st_size, st.st_mtime
+        if save:
+            try:
+                index.save(index_path)
+            except (IOError, OSError):
+                logging.warning("Could not save index %s", index_path)
+        return index
+
+    def matches(self, path):
+        """True if the file at path still looks like the one indexed"""
+        st = os.stat(path)
+        return (st.st_size, st.st_mtime) == (self.size, self.mtime)
+
+    def save(self, index_path):
+        tags = [[list(t.path)] + [getattr(t, k) for k in _fields]
+                for t in self.tags]
+        with open(index_path, 'w') as f:
+            json.dump(dict(format=index_format, version=self.version,
+                           size=self.size, mtime=self.mtime, tags=tags),
+                      f, separators=(',', ':'))
+
+    @classmethod
+    def load(cls, index_path):
+        with open(index_path, 'r') as f:
+            d = json.load(f)
+        if d['format'] != index_format:
+            raise ValueError("Unknown index format %r" % d['format'])
+        tags = [TagInfo(tuple(t[0]),
+                        **dict(zip(_fields, t[1:])))
+                for t in d['tags']]
+        for t in tags:
+            if t.fmt is not None:
+                t.fmt = str(t.fmt)
+        return cls(d['version'], tags, d['size'], d['mtime'])
+
+    def _named(self, pattern):
+        # the paths of the tags pattern (a tuple of names) names exactly,
+        # following only the sections that can match rather than every tag
+        paths = [()]
+        for name in pattern:
+            if _has_wildcard(name):
+                paths = [c for p in paths for c in self.children.get(p, ())
+                         if fnmatchcase(c[-1], name)]
+            else:
+                paths = [p + (name,) for p in paths
+                         if p + (name,) in self.by_path]
+        return paths
+
+    def _below(self, path):
+        # path and the paths of every tag below it
+        yield path
+        for child in self.children.get(path, ()):
+            for p in self._below(child):
+                yield p
+
+    def find(self, pattern):
+        """Returns the TagInfo of every tag matching the tag path pattern"""
+        paths = self._named(TagFilter._split(pattern))
+        return [self.by_path[p] for p in sorted(paths, key=self.position.get)]
+
+    def read(self, f, include=None, exclude=None, array_reader=None):
+        """
+        Reads tags from f, which must be the indexed file, into a dictionary
+        like read_dm_tags does, seeking straight to each wanted tag.
+        include, exclude and array_reader are as for read_dm_tags.
+        """
+        tag_filter = TagFilter(include, exclude)
+        root = {}
+        containers = {(): root}
+
+        def add(path, value):
+            parent = container(path[:-1])
+            if isinstance(parent, list):
+                parent.append(value)
+            else:
+                parent[path[-1]] = value
+
+        def container(path):
+            if path not in containers:
+                value = {} if self.by_path[path].is_dict else []
+                add(path, value)
+                containers[path] = value
+            return containers[path]
+
+        if include is None:
+            tags = self.tags
+        else:
+            # look up just the included tags and what's below them
+            paths = set(p for pattern in tag_filter.include
+                        for named in self._named(pattern)
+                        for p in self._below(named))
+            tags = [self.by_path[p]
+                    for p in sorted(paths, key=self.position.get)]
+        for t in tags:
+            if t.kind == 'section':
+                if tag_filter.keep(t.path) or tag_filter.descend(t.path):
+                    container(t.path)
+            elif tag_filter.keep(t.path):
+                add(t.path, t.read(f, array_reader))
+        return root
@@ -0,0 +1,184 @@
+# Optional instrumentation for reading dm3/dm4 files.
+# A DMStats object can be passed to parse_dm_header, read_dm_tags and
+# load_image to find out where the time goes: how often each rule of the
+# tag walker (see dm_tags.DMTagReader) runs and how long it takes, how many
+# read and seek calls reach the file and how many bytes each rule reads.
+# Nothing is wrapped unless a DMStats is given, so there's no cost
+# otherwise.
+from __future__ import absolute_import, print_function, division
+import json
+import time
+
+try:
+    timer = time.perf_counter
+except AttributeError:
+    timer = time.time
+
+# the DMTagReader methods that are timed, one per grammar rule
+dm_rules = ('header', 'section', 'named_data', 'dataheader', 'array_data')
+
+# the fields of each rule and phase entry
+_entry_fields = ('calls', 'seconds', 'bytes_read')
+
+
+class _NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_null_phase = _NullPhase()
+
+
+class _Phase(object):
+    def __init__(self, stats, entry):
+        self.stats = stats
+        self.entry = entry
+
+    def __enter__(self):
+        self.stats._push(self.entry)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stats._pop()
+        return False
+
+
+def phase(stats, name):
+    """
+    Returns a context manager timing the phase name in stats, or one that
+    does nothing if stats is None.
+    """
+    return _null_phase if stats is None else stats.phase(name)
+
+
+class StatsFile(object):
+    """
+    Wraps the file-like object f, counting the reads and seeks made on it
+    in stats. Everything else is passed through to f.
+    """
+    def __init__(self, f, stats):
+        self.f = f
+        self.stats = stats
+
+    def _count(self, n):
+        stats = self.stats
+        stats.reads += 1
+        stats.bytes_read += n
+        if stats._stack:
+            stats._stack[-1][2] += n
+
+    def read(self, *args):
+        data = self.f.read(*args)
+        self._count(len(data))
+        return data
+
+    def readinto(self, b):
+        n = self.f.readinto(b)
+        self._count(n or 0)
+        return n
+
+    def seek(self, *args):
+        self.stats.seeks += 1
+        return self.f.seek(*args)
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.f.close()
+        return False
+
+
+class DMStats(object):
+    """
+    Collects statistics about reading a file. rules and phases map names to
+    [calls, seconds, bytes_read]. Rules are the DMTagReader methods in
+    dm_rules and phases are the larger steps around them, eg the grammar
+    parse and the conversion to a dictionary. Times and bytes are only
+    counted against the innermost rule or phase running, so nested sections
+    don't count twice and everything adds up to the total.
+    reads, seeks and bytes_read count the calls made on the file.
+    parse_dm_header's grammar path can't be timed rule by rule, so it
+    leaves rules empty and counts only the totals and its phases.
+    The same DMStats can be passed to several reads to accumulate them.
+    """
+    def __init__(self):
+        self.rules = {}
+        self.phases = {}
+        self.reads = 0
+        self.seeks = 0
+        self.bytes_read = 0
+        self._stack = []
+        self._since = None
+
+    @staticmethod
+    def _entry(table, name):
+        entry = table.get(name)
+        if entry is None:
+            entry = table[name] = [0, 0.0, 0]
+        return entry
+
+    def _push(self, entry):
+        now = timer()
+        if self._stack:
+            self._stack[-1][1] += now - self._since
+        entry[0] += 1
+        self._stack.append(entry)
+        self._since = now
+
+    def _pop(self):
+        now = timer()
+        self._stack.pop()[1] += now - self._since
+        self._since = now
+
+    def phase(self, name):
+        """A context manager timing the phase name"""
+        return _Phase(self, self._entry(self.phases, name))
+
+    def timed(self, name, func):
+        """Returns func wrapped to be counted as the rule name"""
+        entry = self._entry(self.rules, name)
+        push, pop = self._push, self._pop
+
+        def wrapper(*args, **kwargs):
+            push(entry)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                pop()
+        return wrapper
+
+    def wrap(self, f):
+        """
+        Returns the file-like object f wrapped to count reads and seeks,
+        unless it counts them in this DMStats already.
+        """
+        if getattr(f, 'stats', None) is self:
+            return f
+        return StatsFile(f, self)
+
+    def instrument(self, reader):
+        """Times the rules of the DMTagReader reader and wraps its file"""
+        reader.f = self.wrap(reader.f)
+        for name in dm_rules:
+            setattr(reader, name, self.timed(name, getattr(reader, name)))
+
+    def to_dict(self):
+        def entries(table):
+            return dict((k, dict(zip(_entry_fields, v)))
+                        for k, v in table.items())
+        return dict(rules=entries(self.rules), phases=entries(self.phases),
+                    reads=self.reads, seeks=self.seeks,
+                    bytes_read=self.bytes_read)
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def __repr__(self):
+        return "DMStats(reads=%d, seeks=%d, bytes_read=%d)" % (
+            self.reads, self.seeks, self.bytes_read)
@@ -0,0 +1,131 @@
+# Reading dm3/dm4 files in a single forward pass, for inputs that can't
+# seek, like pipes, sockets and stdin.
+# The tag walker (see dm_tags.DMTagReader) already keeps track of where it
+# is in the file, and only ever seeks forwards past data it doesn't want or
+# to the start of an array it's about to read. ForwardFile gives it a file
+# whose position is counted rather than asked for, and which seeks forwards
+# by reading and throwing the bytes away, so the walker runs unchanged.
+# Large payloads such as image data can also be handed to a callback chunk
+# by chunk as they arrive, instead of being held in memory.
+from __future__ import absolute_import, print_function, division
+import io
+
+from .dm_tags import DMTagReader, TagFilter
+from .dm_util import ReadIntoMixin
+
+# the arrays stream_dm_tags passes to on_payload by default
+image_payloads = ('ImageList/*/ImageData/Data',)
+
+
+def seekable(f):
+    """True unless the file-like object f says it can't seek"""
+    # python 2 files can't tell us, but are always files on disk
+    try:
+        return f.seekable()
+    except AttributeError:
+        return True
+
+
+class ForwardFile(ReadIntoMixin):
+    """
+    Wraps the file-like object f, which need only have read(), so that it
+    can be read by code that calls tell() and seeks forwards. pos is the
+    offset in the file f is at. Seeking backwards raises
+    io.UnsupportedOperation. Reads block until all the bytes asked for
+    have arrived or f runs out, so pipes giving short reads are fine.
+    """
+    def __init__(self, f, pos=0, chunk_size=1 << 20):
+        self.f = f
+        self.pos = pos
+        self.chunk_size = chunk_size
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            data = self.f.read()
+        else:
+            chunks = []
+            while n > 0:
+                chunk = self.f.read(n)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                n -= len(chunk)
+            data = b''.join(chunks)
+        self.pos += len(data)
+        return data
+
+    def tell(self):
+        return self.pos
+
+    def seekable(self):
+        return False
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence != 0:
+            raise io.UnsupportedOperation("Can only seek from the start or "
+                                          "the current position")
+        if offset < self.pos:
+            raise io.UnsupportedOperation(
+                "Can't seek back to offset %d from %d" % (offset, self.pos))
+        while self.pos < offset:
+            if not self.read(min(self.chunk_size, offset - self.pos)):
+                raise ValueError("Unexpected end of file at offset %d"
+                                 % self.pos)
+        return self.pos
+
+    def close(self):
+        self.f.close()
+
+
+class DMStreamReader(DMTagReader):
+    """
+    A DMTagReader for a file that can only be read forwards, which is
+    wrapped in a ForwardFile (see it for pos). Other arguments are as for
+    DMTagReader.
+    If on_payload is given, the payload of each array whose path an entry
+    of payloads (tag path patterns, see TagFilter) names exactly is passed
+    to on_payload(tag, offset, chunk) in chunks of at most chunk_size bytes
+    as it's read, where tag is the array's TagInfo and offset that of chunk
+    within the payload. The TagInfo is stored in the output in place of
+    the array.
+    """
+    def __init__(self, f, on_payload=None, payloads=image_payloads,
+                 chunk_size=1 << 20, tag_filter=None, stats=None, pos=0,
+                 array_reader=None):
+        if not isinstance(f, ForwardFile):
+            f = ForwardFile(f, pos, chunk_size)
+        self.on_payload = on_payload
+        self.payloads = TagFilter(include=payloads)
+        self.chunk_size = chunk_size
+        DMTagReader.__init__(self, f, array_reader, tag_filter, stats=stats)
+
+    def array_data(self, tag):
+        if self.on_payload is None or not self.payloads.names(tag.path):
+            return DMTagReader.array_data(self, tag)
+        offset = 0
+        while offset < tag.nbytes:
+            chunk = self.read(min(self.chunk_size, tag.nbytes - offset))
+            self.on_payload(tag, offset, chunk)
+            offset += len(chunk)
+        return tag
+
+
+def stream_dm_tags(f, on_payload=None, payloads=image_payloads,
+                   include=None, exclude=None, chunk_size=1 << 20,
+                   stats=None, array_reader=None):
+    """
+    Reads the tags from the dm3 or dm4 file-like object f in one pass,
+    never seeking, into a dictionary of the same form as read_dm_tags
+    returns. f only needs read().
+    on_payload, payloads and chunk_size are as for DMStreamReader: by
+    default, image data is passed to on_payload if it's given. include,
+    exclude, stats and array_reader are as for read_dm_tags; tags that
+    aren't wanted are read and thrown away.
+    """
+    tag_filter = None
+    if include is not None or exclude is not None:
+        tag_filter = TagFilter(include, exclude)
+    return DMStreamReader(f, on_payload, payloads, chunk_size, tag_filter,
+                          stats, array_reader=array_reader).header()
@@ -0,0 +1,429 @@
+# A lightweight reader for the tag structure of dm3 and dm4 files.
+# Rather than building the full grammar tree, this walks the file with plain
+# struct reads and keeps track of where each array payload lives. That lets
+# callers map image data straight from the file instead of decoding it
+# into python objects first.
+#
+# The layout follows general_grammar in parse_dm3_grammar:
+# structure fields (lengths, counts, dtypes) are big endian, while the data
+# itself is little endian (the header's endianness field is always 1).
+from __future__ import absolute_import, print_function, division
+import struct
+import sys
+from array import array
+from fnmatch import fnmatchcase
+from itertools import chain
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# mirrors the simpledata_N definitions in parse_dm3_grammar.general_grammar
+dm_simple_types = {2: 'h',
+                   3: 'i',
+                   4: 'H',
+                   5: 'I',
+                   6: 'f',
+                   7: 'd',
+                   8: 'b',
+                   9: 'b',
+                   10: 'B',
+                   11: 'q',
+                   12: 'Q'}
+
+# the (struct format, size) of the length fields for each file version
+dm_len_types = {3: ('>l', 4),
+                4: ('>Q', 8)}
+
+
+def _to_str(name):
+    # tag names are bytes in the file, we want native strings
+    return name if isinstance(name, str) else name.decode('latin-1')
+
+
+class ArrayRef(object):
+    """
+    Describes where an array payload lives in a file. The payload is count
+    little endian elements of the array typecode typecode, starting at
+    offset bytes from the start of the file. For arrays of structs,
+    typecode has one character per struct field.
+    """
+    def __init__(self, offset, typecode, count):
+        self.offset = offset
+        self.typecode = typecode
+        self.count = count
+
+    @property
+    def nbytes(self):
+        return self.count * struct.calcsize('<' + self.typecode)
+
+    def __repr__(self):
+        return "ArrayRef(offset=%d, typecode=%r, count=%d)" % (
+            self.offset, self.typecode, self.count)
+
+
+def numpy_dtype(typecode):
+    """
+    Returns the numpy dtype for little endian elements of the array typecode
+    typecode. Struct typecodes (with more than one character) give a
+    structured dtype with fields f0, f1, ...
+    """
+    if len(typecode) == 1:
+        return np.dtype('<' + typecode)
+    return np.dtype([('f%d' % i, '<' + c) for i, c in enumerate(typecode)])
+
+
+def _read_struct_array(f, ref):
+    if np is None:
+        fmt = '<' + ref.typecode
+        size = struct.calcsize(fmt)
+        data = f.read(ref.nbytes)
+        return [struct.unpack_from(fmt, data, i * size)
+                for i in range(ref.count)]
+    # read straight into the structured array, with no per element work
+    ret = np.empty(ref.count, numpy_dtype(ref.typecode))
+    buf = ret.view(np.uint8)
+    if hasattr(f, 'readinto'):
+        n = f.readinto(buf)
+    else:
+        data = f.read(ref.nbytes)
+        n = len(data)
+        buf[:n] = np.frombuffer(data, np.uint8)
+    if n != ref.nbytes:
+        raise ValueError("Unexpected end of file reading %r" % ref)
+    return ret
+
+
+def read_array(f, ref):
+    """
+    The default array reader, reads the array described by ref from f into
+    an array.array, like the grammar does. Arrays of structs are read into
+    a numpy structured array (see numpy_dtype), or a list of tuples if numpy
+    isn't available.
+    """
+    f.seek(ref.offset)
+    if len(ref.typecode) > 1:
+        return _read_struct_array(f, ref)
+    ret = array(ref.typecode)
+    data = f.read(ref.nbytes)
+    if hasattr(ret, 'frombytes'):
+        ret.frombytes(data)
+    else:
+        ret.fromstring(data)
+    if sys.byteorder != 'little':
+        ret.byteswap()
+    return ret
+
+
+def struct_array(typecode, items):
+    """
+    Makes an array of structs of the form read_array returns from a
+    sequence of tuples, each with one value per character of typecode.
+    """
+    if np is None:
+        return [tuple(x) for x in items]
+    dtype = numpy_dtype(typecode)
+    if len(set(typecode)) == 1:
+        # eg complex data: the values go straight into one flat array,
+        # which is then viewed as the structs, as read_array does
+        flat = array(typecode[0], chain.from_iterable(items))
+        if sys.byteorder != 'little':
+            flat.byteswap()
+        return np.frombuffer(flat, dtype)
+    items = list(items)
+    ret = np.empty(len(items), dtype)
+    for i, column in enumerate(zip(*items)):
+        ret['f%d' % i] = column
+    return ret
+
+
+class TagFilter(object):
+    """
+    Decides which tags to read from lists of include and exclude tag path
+    patterns. A pattern is a '/' separated tag path whose parts may use
+    fnmatch wildcards, with list entries named by their index, eg
+    'ImageList/*/ImageData/Dimensions'. A pattern matches the tag it names
+    and everything below it. Without include patterns, every tag that isn't
+    excluded is read.
+    """
+    def __init__(self, include=None, exclude=None):
+        self.include = (None if include is None
+                        else [self._split(p) for p in include])
+        self.exclude = [self._split(p) for p in exclude or []]
+
+    @staticmethod
+    def _split(pattern):
+        return tuple(pattern.strip('/').split('/'))
+
+    @staticmethod
+    def _matches(pattern, path):
+        # true if pattern names path or one of its parents
+        return len(pattern) <= len(path) and all(
+            fnmatchcase(name, p) for name, p in zip(path, pattern))
+
+    def excluded(self, path):
+        return any(self._matches(p, path) for p in self.exclude)
+
+    def keep(self, path):
+        """True if the tag at path (a tuple of names) is wanted in full"""
+        if self.excluded(path):
+            return False
+        return self.include is None or any(
+            self._matches(p, path) for p in self.include)
+
+    def names(self, path):
+        """True if an include pattern names exactly the tag at path"""
+        return any(len(p) == len(path) and self._matches(p, path)
+                   for p in self.include or [])
+
+    def descend(self, path):
+        """True if the section at path may contain wanted tags"""
+        if self.excluded(path):
+            return False
+        return self.include is None or any(
+            all(fnmatchcase(name, q) for name, q in zip(path, p))
+            for p in self.include)
+
+
+def _struct_format(info):
+    # info starts at a struct_header:
+    # length, num_fields, then (length, dtype) for each field
+    num_fields = info[1]
+    return '<' + ''.join(dm_simple_types[t]
+                         for t in info[3:3 + 2 * num_fields:2])
+
+
+class TagInfo(object):
+    """
+    Describes where a single tag lives in a file.
+    path is the tuple of names leading to the tag (list entries being named
+    by their index) and kind is one of 'section', 'simple', 'struct',
+    'array' or 'structarray'. Sections only set is_dict. For everything
+    else, offset and nbytes give the span of the data in the file, fmt is
+    the struct format of the value (of one element, for arrays), count is
+    the number of array elements and dtype and arraydtype are the DM type
+    codes.
+    """
+    __slots__ = ('path', 'kind', 'dtype', 'arraydtype', 'fmt', 'count',
+                 'offset', 'nbytes', 'is_dict')
+
+    def __init__(self, path, kind, dtype=None, arraydtype=None, fmt=None,
+                 count=None, offset=None, nbytes=None, is_dict=None):
+        self.path = path
+        self.kind = kind
+        self.dtype = dtype
+        self.arraydtype = arraydtype
+        self.fmt = fmt
+        self.count = count
+        self.offset = offset
+        self.nbytes = nbytes
+        self.is_dict = is_dict
+
+    @classmethod
+    def from_info(cls, path, info, offset):
+        """
+        Creates the TagInfo for a data tag from the length fields of its
+        dataheader (everything after headerlen) and the offset of its data.
+        """
+        dtype = info[0]
+        arraydtype = count = None
+        if dtype == 20:
+            arraydtype, count = info[1], info[-1]
+            if arraydtype == 15:
+                kind, fmt = 'structarray', _struct_format(info[2:])
+            else:
+                kind, fmt = 'array', '<' + dm_simple_types[arraydtype]
+        elif dtype == 15:
+            kind, fmt = 'struct', _struct_format(info[1:])
+        else:
+            kind, fmt = 'simple', '<' + dm_simple_types[dtype]
+        nbytes = struct.calcsize(fmt) * (1 if count is None else count)
+        return cls(path, kind, dtype, arraydtype, fmt, count, offset, nbytes)
+
+    @property
+    def array_ref(self):
+        return ArrayRef(self.offset, self.fmt[1:], self.count)
+
+    def decode(self, data):
+        """Converts the raw bytes of a (non array) tag into its value"""
+        value = struct.unpack(self.fmt, data)
+        return value if self.kind == 'struct' else value[0]
+
+    def read(self, f, array_reader=None):
+        """Reads the value of the tag from f"""
+        if self.kind in ('array', 'structarray'):
+            return (array_reader or read_array)(f, self.array_ref)
+        f.seek(self.offset)
+        return self.decode(f.read(self.nbytes))
+
+    def __repr__(self):
+        return "TagInfo(%r, %r)" % ('/'.join(self.path), self.kind)
+
+
+# returned by the reader methods for tags that were skipped
+_skipped = object()
+
+
+class DMTagReader(object):
+    """
+    Walks the tag structure of a dm3 or dm4 file. Each method corresponds to
+    the grammar rule of the same name. Array payloads are not read by the
+    walker itself, instead array_reader(f, ref) is called with an ArrayRef
+    and its result is stored in the output.
+    If tag_filter is given (a TagFilter), tags it doesn't want are skipped
+    over without being read.
+    If on_tag is given, it's called with a TagInfo for every tag that's
+    walked past. Unless walk_skipped is True, skipped dm4 entries are jumped
+    over whole, so on_tag doesn't see what's in them.
+    If stats is given (a dm_stats.DMStats), each rule method is timed and
+    the reads and seeks made on f are counted in it.
+    """
+    def __init__(self, f, array_reader=None, tag_filter=None, on_tag=None,
+                 walk_skipped=False, stats=None):
+        self.f = f
+        self.array_reader = array_reader or read_array
+        self.tag_filter = tag_filter
+        self.on_tag = on_tag
+        self.walk_skipped = walk_skipped
+        self.pos = f.tell()
+        if stats is not None:
+            stats.instrument(self)
+
+    def read(self, n):
+        data = self.f.read(n)
+        if len(data) != n:
+            raise ValueError("Unexpected end of file at offset %d" % self.pos)
+        self.pos += n
+        return data
+
+    def unpack(self, fmt):
+        return struct.unpack(fmt, self.read(struct.calcsize(fmt)))
+
+    def read_len(self):
+        return self.unpack(self.len_type)[0]
+
+    def skip(self, n):
+        self.f.seek(self.pos + n)
+        self.pos += n
+
+    def header(self):
+        version, = self.unpack('>l')
+        if version not in dm_len_types:
+            raise ValueError("File is neither a dm3 nor dm4 file!")
+        self.version = version
+        self.len_type, self.len_size = dm_len_types[version]
+        self.read_len()
+        endianness, = self.unpack('>l')
+        if endianness != 1:
+            raise ValueError("Unsupported endianness %d" % endianness)
+        return self.section(())
+
+    def section(self, path, skip=False):
+        is_dict, is_open = self.unpack('>bb')
+        num_tags = self.read_len()
+        if self.on_tag is not None and path:
+            self.on_tag(TagInfo(path, 'section', is_dict=bool(is_dict)))
+        ret = {} if is_dict else []
+        for i in range(num_tags):
+            name, value = self.named_data(path, None if is_dict else i, skip)
+            if value is _skipped:
+                continue
+            if is_dict:
+                ret[name] = value
+            else:
+                ret.append(value)
+        return _skipped if skip else ret
+
+    def named_data(self, path, index, skip=False):
+        start = self.pos
+        sdtype, name_length = self.unpack('>bH')
+        name = _to_str(self.read(name_length))
+        datalen = self.unpack('>Q')[0] if self.version == 4 else None
+        if sdtype not in (20, 21):
+            raise ValueError("Unknown tag type %d at offset %d" % (
+                sdtype, start))
+        path = path + (name if index is None else str(index),)
+        if (not skip and self.tag_filter is not None
+                and not self.tag_filter.keep(path)):
+            if sdtype == 20 and self.tag_filter.descend(path):
+                return name, self.section(path)
+            skip = True
+        if skip and datalen is not None and not self.walk_skipped:
+            # dm4 tells us the size of the entry, so we can jump over it
+            self.skip(datalen)
+            return name, _skipped
+        if sdtype == 20:
+            return name, self.section(path, skip)
+        return name, self.dataheader(path, skip)
+
+    def dataheader(self, path, skip=False):
+        delim = self.read(4)
+        if delim != b'%%%%':
+            raise ValueError("Bad tag delimiter at offset %d" % (self.pos - 4))
+        headerlen = self.read_len()
+        # everything describing the data is a run of length fields
+        info = self.unpack('>' + self.len_type[1] * headerlen)
+        tag = TagInfo.from_info(path, info, self.pos)
+        if self.on_tag is not None:
+            self.on_tag(tag)
+        if skip:
+            self.skip(tag.nbytes)
+            return _skipped
+        if tag.kind in ('array', 'structarray'):
+            return self.array_data(tag)
+        return tag.decode(self.read(tag.nbytes))
+
+    def array_data(self, tag):
+        ret = self.array_reader(self.f, tag.array_ref)
+        self.skip(tag.nbytes)
+        return ret
+
+
+def read_dm_tags(f, array_reader=None, include=None, exclude=None,
+                 stats=None):
+    """
+    Reads the tags from the dm3 or dm4 file-like object f into a dictionary
+    of the same form as dm3_to_dictionary returns.
+    array_reader(f, ref) is called for every array payload, where ref is an
+    ArrayRef giving its location, and should return the value to store. It
+    can move the file position freely.
+    include and exclude are lists of tag path patterns (see TagFilter).
+    Tags that aren't wanted are left out of the output and are skipped over
+    with seeks, so their data is never read.
+    stats is an optional dm_stats.DMStats to count the work done in.
+    """
+    tag_filter = None
+    if include is not None or exclude is not None:
+        tag_filter = TagFilter(include, exclude)
+    return DMTagReader(f, array_reader, tag_filter, stats=stats).header()
+
+
+def scan_dm_tags(f):
+    """
+    Walks every tag in the dm3 or dm4 file-like object f without reading
+    any data. Returns the file version and a list of TagInfo, one for every
+    tag in file order.
+    """
+    tags = []
+    reader = DMTagReader(f, tag_filter=TagFilter(include=[]),
+                         on_tag=tags.append, walk_skipped=True)
+    reader.header()
+    return reader.version, tags
+
+
+def find_dm_tags(f, patterns):
+    """
+    Returns the TagInfo of every data tag in the file-like object f whose
+    path matches one of the tag path patterns (see TagFilter) exactly.
+    Only the parts of the file leading to those tags are walked, and no
+    arrays are read.
+    """
+    tag_filter = TagFilter(include=patterns)
+    found = []
+
+    def on_tag(tag):
+        if tag.kind != 'section' and tag_filter.names(tag.path):
+            found.append(tag)
+    DMTagReader(f, lambda f, ref: ref, tag_filter, on_tag).header()
+    return found
@@ -0,0 +1,81 @@
+# Small helpers shared by the readers: a thread safe LRU cache, used for
+# the per-file caches of seek points, tag indexes and grammars, and a
+# readinto() for file-like objects that only know how to read().
+from __future__ import absolute_import, print_function, division
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    A thread safe mapping that holds at most max_bytes worth of values,
+    dropping the least recently used ones first to make room. sizeof(value)
+    gives the size of a value, by default its nbytes. With sizeof=lambda
+    v: 1, max_bytes is the number of values kept.
+    """
+    def __init__(self, max_bytes, sizeof=lambda v: v.nbytes):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.nbytes = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+            value, size = self.items.pop(key)
+            self.items[key] = value, size
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self._put(key, value)
+
+    def _put(self, key, value):
+        size = self.sizeof(value)
+        if key in self.items:
+            self.nbytes -= self.items.pop(key)[1]
+        if size > self.max_bytes:
+            return
+        while self.nbytes + size > self.max_bytes:
+            self.nbytes -= self.items.popitem(last=False)[1][1]
+        self.items[key] = value, size
+        self.nbytes += size
+
+    def get_or_put(self, key, make, valid=lambda value: True):
+        """
+        Returns the value for key if there is one and valid(value) is true,
+        otherwise puts make() there and returns that. make is called with
+        the lock held, so threads asking for the same key together all get
+        the one value.
+        """
+        with self.lock:
+            if key in self.items:
+                value, size = self.items.pop(key)
+                self.items[key] = value, size
+                if valid(value):
+                    return value
+            value = make()
+            self._put(key, value)
+            return value
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+
+class ReadIntoMixin(object):
+    """
+    Gives a file-like object with read(n) a readinto(b) made from it, for
+    code (eg numpy's readinto based readers) that wants one.
+    """
+    def readinto(self, b):
+        # b is a buffer of bytes
+        view = memoryview(b)
+        data = self.read(len(view))
+        view[:len(data)] = data
+        return len(data)
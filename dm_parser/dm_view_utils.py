@@ -0,0 +1,100 @@
+# The parts of the image viewer (see show_dm3_file) that don't need Tk:
+# histograms, contrast limits and the binned pyramid used for tiled
+# display. The decoded image cache is dm_util.LRUCache.
+from __future__ import absolute_import, print_function, division
+import threading
+
+import numpy as np
+
+
+class ImageHistogram(object):
+    """
+    The histogram of an image, counted once in fine_bins bins over its
+    whole range. Histograms over any other range are then made by rebinning
+    those counts, so changing the contrast limits doesn't need another pass
+    over the image.
+    """
+    def __init__(self, im, fine_bins=4096):
+        self.lo, self.hi = float(np.min(im)), float(np.max(im))
+        hi = self.hi if self.hi > self.lo else self.lo + 1
+        counts, self.edges = np.histogram(im, bins=fine_bins,
+                                          range=(self.lo, hi))
+        self.cumulative = np.concatenate([[0], np.cumsum(counts)])
+
+    def histogram(self, bins, range):
+        # counts are taken as spread evenly across each fine bin
+        edges = np.linspace(range[0], range[1], bins + 1)
+        return np.diff(np.interp(edges, self.edges, self.cumulative))
+
+
+def sample_pixels(im, sample_size):
+    """
+    Returns a flat sample of about sample_size of the pixels of im, taking
+    every n'th row and column (or element, for 1d images). Only the sampled
+    pixels are touched, so memory mapped images are barely read.
+    """
+    if im.size <= sample_size:
+        return im.reshape(-1)
+    if im.ndim >= 2:
+        step = int(np.ceil(np.sqrt(1.0 * im.size / sample_size)))
+        sample = im[..., ::step, ::step]
+    else:
+        sample = im[::int(np.ceil(1.0 * im.size / sample_size))]
+    return np.ascontiguousarray(sample).reshape(-1)
+
+
+class AutoContrast(object):
+    """
+    Contrast limits for im at the given low and high percentiles of its
+    values, so a few hot or dead pixels don't matter, and an ImageHistogram
+    to go with them. Both are worked out from a sample of about sample_size
+    pixels (see sample_pixels), which takes milliseconds whatever the size
+    of the image. refine() works them out again from every pixel.
+    """
+    def __init__(self, im, percentiles=(0.1, 99.9), sample_size=1 << 18):
+        self.percentiles = percentiles
+        self.limits, self.histogram = self._compute(
+            sample_pixels(im, sample_size))
+        self.refined = False
+
+    def _compute(self, values):
+        lo, hi = np.percentile(values, self.percentiles)
+        if hi <= lo:
+            hi = lo + 1
+        return (float(lo), float(hi)), ImageHistogram(values)
+
+    def refine(self, im, background=True):
+        """
+        Recomputes limits and histogram from all of im, on a daemon thread
+        if background is True. refined is set once they've been updated.
+        """
+        def run():
+            self.limits, self.histogram = self._compute(
+                np.asarray(im).reshape(-1))
+            self.refined = True
+        if not background:
+            return run()
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+class ImagePyramid(object):
+    """
+    Successively 2x2 binned copies of the 2d image im, level n being binned
+    by 2**n. Each level is made from the one before the first time it's
+    asked for, then kept. Level 0 is im itself.
+    """
+    def __init__(self, im):
+        self.levels = [im]
+
+    def level(self, n):
+        while len(self.levels) <= n:
+            prev = self.levels[-1]
+            h, w = prev.shape[0] // 2, prev.shape[1] // 2
+            if h == 0 or w == 0:
+                break
+            self.levels.append(prev[:2 * h, :2 * w].reshape(h, 2, w, 2).mean(
+                axis=(1, 3), dtype=np.float32))
+        return self.levels[min(n, len(self.levels) - 1)]
@@ -0,0 +1,472 @@
+# Writes dictionaries (like the ones dm3_to_dictionary returns) straight to
+# dm3 or dm4 files, without going through the grammar.
+# The size of every entry is worked out before anything is written, so the
+# file is written front to back in one pass, and array data (numpy arrays,
+# array.arrays or anything else supporting the buffer protocol) is handed
+# to f.write as is rather than being copied into python objects first.
+from __future__ import absolute_import, print_function, division
+import struct
+import sys
+from array import array
+
+from .dm_tags import (dm_len_types, dm_simple_types, np, numpy_dtype, _to_str,
+                      find_dm_tags, TagFilter)
+
+# the DM type for each (kind, size) of array element, kind being as for
+# numpy's dtype.kind. This should mirror simpledata_N in the grammar.
+dm_array_types = {('i', 1): 8,
+                  ('b', 1): 8,
+                  ('u', 1): 10,
+                  ('i', 2): 2,
+                  ('u', 2): 4,
+                  ('i', 4): 3,
+                  ('u', 4): 5,
+                  ('f', 4): 6,
+                  ('f', 8): 7,
+                  ('i', 8): 11,
+                  ('u', 8): 12}
+
+# and the typecode we write each DM type with
+dm_write_typecodes = {2: 'h', 3: 'i', 4: 'H', 5: 'I', 6: 'f', 7: 'd', 8: 'b',
+                      10: 'B', 11: 'q', 12: 'Q'}
+
+# like header_offset in parse_dm3_grammar's grammar definitions
+_header_offsets = {3: 4, 4: 0}
+
+try:
+    _int_types = (int, long)
+except NameError:
+    _int_types = (int,)
+
+
+def _to_bytes(name):
+    return name if isinstance(name, bytes) else name.encode('latin-1')
+
+
+def _typecode_kind(typecode):
+    # the numpy style kind of an array/struct typecode
+    if typecode in 'fd':
+        return 'f'
+    elif typecode == '?':
+        return 'b'
+    return 'u' if typecode.isupper() else 'i'
+
+
+def scalar_dm_type(value):
+    """The DM type we write the python scalar value as"""
+    if isinstance(value, bool):
+        return 8
+    elif isinstance(value, float):
+        return 7
+    elif -2 ** 31 <= value < 2 ** 31:
+        return 3
+    return 11 if value < 0 else 12
+
+
+def array_dm_type(data):
+    """
+    Returns the DM type (and, for numpy structured arrays, the list of field
+    types) for the array-like data.
+    """
+    if np is not None and isinstance(data, np.ndarray):
+        if data.dtype.names:
+            return 15, [array_dm_type(np.empty(0, data.dtype[n]))[0]
+                        for n in data.dtype.names]
+        return dm_array_types[(data.dtype.kind, data.dtype.itemsize)], None
+    if isinstance(data, array):
+        typecode, itemsize = data.typecode, data.itemsize
+    else:
+        m = memoryview(data)
+        typecode, itemsize = m.format.lstrip('@=<>!'), m.itemsize
+    return dm_array_types[(_typecode_kind(typecode), itemsize)], None
+
+
+def _little_endian(data, typecode):
+    """
+    Returns data as a flat, contiguous buffer of little endian elements of
+    typecode, only copying it if it isn't one already.
+    """
+    if np is not None and isinstance(data, np.ndarray):
+        data = np.ascontiguousarray(data).reshape(-1)
+        target = numpy_dtype(typecode)
+        if data.dtype != target:
+            data = data.astype(target)
+        return data
+    if sys.byteorder != 'little':
+        data = array(typecode, data)
+        data.byteswap()
+    return data
+
+
+def _write_buffer(f, data):
+    if isinstance(data, array) and not hasattr(data, 'tobytes'):
+        # python 2 arrays don't support the new buffer protocol
+        data = data.tostring()
+    f.write(data)
+
+
+class _Section(object):
+    def __init__(self, is_dict, entries, size):
+        self.is_dict = is_dict
+        self.entries = entries
+        self.size = size
+
+
+class _Data(object):
+    def __init__(self, info, payload, nbytes, size):
+        self.info = info
+        self.payload = payload
+        self.nbytes = nbytes
+        self.size = size
+
+
+class DMTagWriter(object):
+    """
+    Writes a dm3 (version=3) or dm4 (version=4) file to f. Values are planned
+    first (working out every size), then written out in order.
+    """
+    def __init__(self, f, version=3):
+        self.f = f
+        self.version = version
+        self.len_type, self.len_size = dm_len_types[version]
+
+    def plan(self, value):
+        if isinstance(value, (dict, list)):
+            return self.plan_section(value)
+        return self.plan_data(value)
+
+    def plan_section(self, d):
+        if isinstance(d, dict):
+            items = d.items()
+        else:
+            items = (('', x) for x in d)
+        entries = []
+        size = 2 + self.len_size
+        for name, value in items:
+            name = _to_bytes(name)
+            node = self.plan(value)
+            entries.append((name, node))
+            size += 3 + len(name) + node.size
+            if self.version == 4:
+                size += 8
+        return _Section(isinstance(d, dict), entries, size)
+
+    def plan_data(self, data):
+        if np is not None and isinstance(data, np.generic):
+            data = data.item()
+        if isinstance(data, tuple):
+            types = [scalar_dm_type(x) for x in data]
+            fmt = '<' + ''.join(dm_write_typecodes[t] for t in types)
+            info = [15] + self.struct_header(types)
+            payload = struct.pack(fmt, *data)
+            nbytes = len(payload)
+        elif isinstance(data, (bool, float) + _int_types):
+            dtype = scalar_dm_type(data)
+            info = [dtype]
+            payload = struct.pack('<' + dm_write_typecodes[dtype], data)
+            nbytes = len(payload)
+        else:
+            arraydtype, types = array_dm_type(data)
+            if types is None:
+                typecode = dm_write_typecodes[arraydtype]
+                info = [20, arraydtype]
+            else:
+                typecode = ''.join(dm_write_typecodes[t] for t in types)
+                info = [20, 15] + self.struct_header(types)
+            payload = _little_endian(data, typecode)
+            itemsize = struct.calcsize('<' + typecode)
+            if np is not None and isinstance(payload, np.ndarray):
+                count = payload.size
+            elif isinstance(payload, array):
+                count = len(payload)
+            else:
+                count = memoryview(payload).nbytes // itemsize
+            info.append(count)
+            nbytes = count * itemsize
+        size = 4 + self.len_size * (1 + len(info)) + nbytes
+        return _Data(info, payload, nbytes, size)
+
+    @staticmethod
+    def struct_header(types):
+        ret = [0, len(types)]
+        for t in types:
+            ret.extend((0, t))
+        return ret
+
+    def write_len(self, *values):
+        self.f.write(struct.pack('>' + self.len_type[1] * len(values),
+                                 *values))
+
+    def write(self, d):
+        """Writes the whole file for the tag dictionary d"""
+        self.write_root(self.plan_section(d))
+
+    def write_root(self, root):
+        self.f.write(struct.pack('>l', self.version))
+        self.write_len(root.size + _header_offsets[self.version])
+        self.f.write(struct.pack('>l', 1))
+        self.write_section(root)
+        self.f.write(b'\0' * 8)
+
+    def write_section(self, section, path=()):
+        self.f.write(struct.pack('>bb', section.is_dict, 0))
+        self.write_len(len(section.entries))
+        for i, (name, node) in enumerate(section.entries):
+            entry_path = path + (
+                _to_str(name) if section.is_dict else str(i),)
+            is_section = isinstance(node, _Section)
+            self.f.write(struct.pack('>bH', 20 if is_section else 21,
+                                     len(name)))
+            self.f.write(name)
+            if self.version == 4:
+                self.write_datalen(entry_path, node.size)
+            if is_section:
+                self.write_section(node, entry_path)
+            else:
+                self.write_data(node, entry_path)
+
+    def write_datalen(self, path, size):
+        self.f.write(struct.pack('>Q', size))
+
+    def write_data(self, node, path):
+        self.f.write(b'%%%%')
+        self.write_len(len(node.info), *node.info)
+        # arrays go to the file straight from their own memory
+        _write_buffer(self.f, node.payload)
+
+
+def write_dm(f, d, version=3):
+    """
+    Writes the tag dictionary d (of the form dm3_to_dictionary returns) to
+    the file-like object f as a dm3 (version=3) or dm4 (version=4) file.
+    dicts and lists become sections, tuples structs and python scalars
+    simple tags. numpy arrays, array.arrays and other buffer protocol objects
+    become array tags, with numpy structured arrays written as arrays of
+    structs. Arrays are written from their own memory with a single write
+    each, only being copied if they aren't contiguous and little endian.
+    """
+    DMTagWriter(f, version).write(d)
+
+
+class StreamedArray(object):
+    """
+    Stands in for array data that's passed to a DMStreamWriter in chunks.
+    dtype is the numpy dtype of the elements and count is how many are
+    expected, which can be 0 if that isn't known yet.
+    """
+    def __init__(self, dtype, count=0):
+        self.dtype = np.dtype(dtype)
+        self.count = count
+
+
+class DMStreamWriter(DMTagWriter):
+    """
+    Writes a dm3 or dm4 file whose array data arrives in chunks.
+    The tag dictionary d must hold one StreamedArray, as the last entry of
+    the last entry (and so on) of the root, so that its data is the last
+    thing in the file. Everything up to that data is written straight away;
+    the data is then written one chunk at a time with write_chunk, and
+    close() finishes the file.
+    If the number of elements written doesn't match the StreamedArray's
+    count, every length that depends on it (the header length, the array
+    length and any dm4 datalen fields) is patched on close, which needs f
+    to be seekable. Simple tags can also be changed with patch before then,
+    eg to fill in dimensions that weren't known up front.
+    Only one chunk needs to be in memory at a time.
+    """
+    stream_path = None
+
+    def __init__(self, f, d, version=3):
+        DMTagWriter.__init__(self, f, version)
+        self.datalens = {}
+        self.data_offsets = {}
+        self.data_nodes = {}
+        self.start = f.tell()
+        self.root = self.plan_section(d)
+        self.f.write(struct.pack('>l', self.version))
+        self.write_len(self.root.size + _header_offsets[self.version])
+        self.f.write(struct.pack('>l', 1))
+        self.write_section(self.root)
+        if self.stream_path is None:
+            raise ValueError("No StreamedArray to write")
+        self.nbytes = 0
+
+    def write_section(self, section, path=()):
+        if self.stream_path is not None:
+            raise ValueError("The StreamedArray must be the last tag")
+        DMTagWriter.write_section(self, section, path)
+
+    def plan_data(self, data):
+        if isinstance(data, StreamedArray):
+            arraydtype, types = array_dm_type(np.empty(0, data.dtype))
+            if types is None:
+                typecode = dm_write_typecodes[arraydtype]
+                info = [20, arraydtype, data.count]
+            else:
+                typecode = ''.join(dm_write_typecodes[t] for t in types)
+                info = [20, 15] + self.struct_header(types) + [data.count]
+            self.stream_typecode = typecode
+            self.itemsize = struct.calcsize('<' + typecode)
+            nbytes = data.count * self.itemsize
+            size = 4 + self.len_size * (1 + len(info)) + nbytes
+            return _Data(info, None, nbytes, size)
+        return DMTagWriter.plan_data(self, data)
+
+    def write_datalen(self, path, size):
+        self.datalens[path] = (self.f.tell(), size)
+        DMTagWriter.write_datalen(self, path, size)
+
+    def write_data(self, node, path):
+        if self.stream_path is not None:
+            raise ValueError("The StreamedArray must be the last tag")
+        if node.payload is None:
+            self.stream_path = path
+            self.stream_node = node
+            self.f.write(b'%%%%')
+            self.write_len(len(node.info), *node.info)
+            self.data_offsets[path] = self.f.tell()
+            return
+        self.data_nodes[path] = node
+        DMTagWriter.write_data(self, node, path)
+        self.data_offsets[path] = self.f.tell() - node.nbytes
+
+    def write_chunk(self, chunk):
+        """Writes the next chunk of array data"""
+        if np is not None and isinstance(chunk, np.ndarray):
+            chunk = _little_endian(chunk, self.stream_typecode)
+            nbytes = chunk.nbytes
+        else:
+            nbytes = memoryview(chunk).nbytes
+        self.f.write(chunk)
+        self.nbytes += nbytes
+
+    def patch(self, path, value):
+        """
+        Overwrites the value of the simple tag at path (a tuple of names,
+        list entries being named by their index) with value.
+        """
+        node = self.data_nodes[path]
+        pos = self.f.tell()
+        self.f.seek(self.data_offsets[path])
+        self.f.write(struct.pack('<' + dm_write_typecodes[node.info[0]],
+                                 value))
+        self.f.seek(pos)
+
+    def close(self):
+        """Finishes the file, patching any lengths that have changed"""
+        self.f.write(b'\0' * 8)
+        if self.nbytes % self.itemsize:
+            raise ValueError("Data isn't a whole number of elements")
+        delta = self.nbytes - self.stream_node.nbytes
+        if delta == 0:
+            return
+        end = self.f.tell()
+        self.f.seek(self.start + 4)
+        self.write_len(self.root.size + _header_offsets[self.version] + delta)
+        for i in range(1, len(self.stream_path) + 1):
+            if self.stream_path[:i] in self.datalens:
+                pos, size = self.datalens[self.stream_path[:i]]
+                self.f.seek(pos)
+                self.f.write(struct.pack('>Q', size + delta))
+        self.f.seek(self.data_offsets[self.stream_path] - self.len_size)
+        self.write_len(self.nbytes // self.itemsize)
+        self.f.seek(end)
+
+
+def _check_scalar(typecode, value):
+    # python numbers can go into any tag of the same kind, except that ints
+    # are allowed into floats
+    kind = _typecode_kind(typecode)
+    if isinstance(value, float):
+        ok = kind == 'f'
+    elif isinstance(value, (bool,) + _int_types):
+        ok = kind in 'iuf'
+    else:
+        ok = False
+    if not ok:
+        raise TypeError("Can't store %r in a tag of type %r" % (
+            value, typecode))
+
+
+def encode_tag_value(tag, value):
+    """
+    Returns the data to write over the tag described by the TagInfo tag to
+    give it value, raising TypeError or ValueError if value doesn't have the
+    tag's DM type and size.
+    """
+    if np is not None and isinstance(value, np.generic):
+        value = value.item()
+    if tag.kind == 'section':
+        raise TypeError("Can't patch the section %s" % '/'.join(tag.path))
+    elif tag.kind in ('array', 'structarray'):
+        arraydtype, types = array_dm_type(value)
+        if types is None:
+            typecode = dm_simple_types[arraydtype]
+        else:
+            typecode = ''.join(dm_simple_types[t] for t in types)
+        if typecode != tag.fmt[1:]:
+            raise TypeError("Array of type %r doesn't match tag type %r" % (
+                typecode, tag.fmt[1:]))
+        payload = _little_endian(value, typecode)
+    else:
+        values = value if tag.kind == 'struct' else (value,)
+        if len(values) != len(tag.fmt) - 1:
+            raise ValueError("Expected %d values, got %d" % (
+                len(tag.fmt) - 1, len(values)))
+        for typecode, x in zip(tag.fmt[1:], values):
+            _check_scalar(typecode, x)
+        try:
+            payload = struct.pack(tag.fmt, *values)
+        except struct.error as e:
+            raise ValueError(str(e))
+    if isinstance(payload, array):
+        nbytes = len(payload) * payload.itemsize
+    else:
+        nbytes = memoryview(payload).nbytes
+    if nbytes != tag.nbytes:
+        raise ValueError("New value is %d bytes, the tag holds %d" % (
+            nbytes, tag.nbytes))
+    return payload
+
+
+def patch_dm_tags(file, values, index=None):
+    """
+    Changes tags of an existing dm3 or dm4 file in place. values maps tag
+    path patterns (see dm_tags.TagFilter) to the new value for every tag
+    they name, eg {'ImageList/1/ImageData/Calibrations/Dimension/0/Scale':
+    0.5}. Each new value must have the same DM type and size as the tag it
+    replaces (python ints and floats are converted to the tag's own type),
+    and only the bytes of the tag data are rewritten.
+    file is a path or a file-like object opened for reading and writing.
+    index is an optional dm_index.TagIndex for the file, to find the tags
+    without walking it. Returns the number of tags changed; nothing is
+    written unless every value is acceptable.
+    """
+    if isinstance(file, str):
+        with open(file, 'r+b') as f:
+            return patch_dm_tags(f, values, index)
+    patterns = list(values)
+    if index is not None:
+        tags = [t for t in index.tags if t.kind != 'section'
+                and TagFilter(include=patterns).names(t.path)]
+    else:
+        start = file.tell()
+        tags = find_dm_tags(file, patterns)
+        file.seek(start)
+    writes = []
+    for pattern in patterns:
+        tag_filter = TagFilter(include=[pattern])
+        matched = [t for t in tags if tag_filter.names(t.path)]
+        if not matched:
+            raise KeyError("No tag matches %r" % pattern)
+        for tag in matched:
+            writes.append((tag.offset, encode_tag_value(tag, values[pattern])))
+    for offset, payload in writes:
+        file.seek(offset)
+        _write_buffer(file, payload)
+    return len(writes)
+
+
+def patch_dm_tag(file, path, value, index=None):
+    """Changes the single tag at path in place, see patch_dm_tags"""
+    return patch_dm_tags(file, {path: value}, index)
@@ -3,8 +3,17 @@
 # to and from dictionaries, and extracting images
 from __future__ import absolute_import, print_function, division
 import logging
+import struct
+import threading
 from array import array
 from file_grammar import ParsedGrammar
+from .dm_stats import phase
+from .dm_stream import seekable, stream_dm_tags
+from .dm_compressed import CompressedFile, decompressed
+from .dm_tags import (TagFilter, read_dm_tags, dm_simple_types, struct_array,
+                      np)
+from .dm_writer import array_dm_type, dm_write_typecodes
+from .dm_util import LRUCache
 
 general_grammar = """
 header:     version(>l)=__version__, len(__len_type__), endianness(>l)=1, _pos=f.tell(), section, 
@@ -41,7 +50,7 @@ simpledata_6 = f
 simpledata_7 = d
 simpledata_8 = b
 simpledata_9 = b
-simpledata_10 = b
+simpledata_10 = B
 simpledata_11 = q
 simpledata_12 = Q
 
@@ -97,19 +106,61 @@ dm3_grammar = replace_map(general_grammar, dm3_grammar_defs)
 dm3_grammar2 = replace_map(general_grammar, dm3_grammar_defs2)
 dm4_grammar = replace_map(general_grammar, dm4_grammar_defs)
 
-def dm3_to_dictionary(d):
+dm_grammars = {'dm3': dm3_grammar,
+               'dm3_2': dm3_grammar2,
+               'dm4': dm4_grammar}
+
+# how many compiled grammars each thread keeps
+grammar_cache_size = 8
+
+# each thread's compiled grammars, keyed by (grammar text, root rule)
+_grammar_local = threading.local()
+
+def get_grammar(grammar='dm3', root='header'):
+    """
+    Returns the compiled ParsedGrammar for grammar, which is either one of
+    the names in dm_grammars or the grammar text itself. Grammars are only
+    compiled the first time a thread asks for them, and after that the same
+    instance is returned to it. Nothing says a ParsedGrammar can be shared
+    by threads parsing at once, so each thread has its own. The
+    grammar_cache_size most recently used are kept, so generated grammar
+    texts don't pile up.
+    """
+    cache = getattr(_grammar_local, 'grammars', None)
+    if cache is None:
+        cache = _grammar_local.grammars = LRUCache(grammar_cache_size,
+                                                   sizeof=lambda g: 1)
+    key = (dm_grammars.get(grammar, grammar), root)
+    return cache.get_or_put(key, lambda: ParsedGrammar(key[0], root))
+
+def dm3_to_dictionary(d, include=None, exclude=None):
     """
     Convert the tagged grammer from a dm3 file into a dictionary.
     We convert named data to dictionaries and unnamed to lists.
+    include and exclude are optional lists of tag path patterns (see
+    dm_tags.TagFilter), tags that don't match are left out of the output.
     """
-    def add_to_out(type, data):
+    tag_filter = None
+    if include is not None or exclude is not None:
+        tag_filter = TagFilter(include, exclude)
+
+    def wanted(item, path):
+        if tag_filter is None or tag_filter.keep(path):
+            return True
+        return 'section' in item and tag_filter.descend(path)
+
+    def add_to_out(type, data, path=()):
         #print type, data
         if type == "section":
             is_dict = data['is_dict']
             ret = {} if is_dict else []
-            for item in data['data']:
+            for i, item in enumerate(data['data']):
+                item_path = path + (item['name'] if is_dict else str(i),)
+                if not wanted(item, item_path):
+                    continue
                 if 'section' in item:
-                    new_obj = add_to_out('section', item['section'])
+                    new_obj = add_to_out('section', item['section'],
+                                         item_path)
                 else:
                     new_obj = add_to_out('dataheader', item['dataheader'])
                 if is_dict:
@@ -121,12 +172,37 @@ def dm3_to_dictionary(d):
             if 'struct_data' in data:
                 return tuple(data['struct_data']['data'])
             elif 'array_data' in data:
-                return data['array_data']['array']
+                array_data = data['array_data']
+                if array_data['arraydtype'] == 15:
+                    # arrays of structs become numpy structured arrays
+                    typecode = ''.join(
+                        dm_simple_types[t['dtype']]
+                        for t in array_data['struct_header']['types'])
+                    return struct_array(typecode, (
+                        s['data'] for s in array_data['array']))
+                return array_data['array']
             else:
                 return data['data']
 
     return add_to_out('section', d['section'])
 
+def _to_array(data, typecode):
+    # copies the numpy array or buffer data into an array.array of
+    # typecode, which is what the grammar writes. That's one copy of the
+    # bytes, converting the type first if it has to.
+    if np is not None and isinstance(data, np.ndarray):
+        data = np.ascontiguousarray(data, np.dtype(typecode))
+    ret = array(typecode)
+    m = memoryview(data)
+    if not hasattr(ret, 'frombytes'):
+        # python 2
+        ret.fromstring(m.tobytes())
+    elif m.c_contiguous:
+        ret.frombytes(m.cast('B'))
+    else:
+        ret.frombytes(m.tobytes())
+    return ret
+
 def dict_to_dm3(d):
     """
     Convert a dictionary (like the one returned from dm3_to_dictionary) into
@@ -137,13 +213,12 @@ def dict_to_dm3(d):
     # 2. simple data to dataheader
     # 3. array.array to array dataheader
     # 4. tuple to struct dataheader
-    # Note that arrays of structs in dm3 files currently get translated to
-    # lists of lists, and as such we have no way of handling that. options are
-    # to either convert to a unique standard type (eg tuple of tuples),
-    # or a custom type, add a hint to the parser to parse as
-    # an array of structs, or simply not support it. (although I think it's
-    # needed for complex data types? - in which case we should find a better
-    # way of converting it in dm3_to_dictionary)
+    # 5. numpy structured array to an array of structs dataheader
+    # (this is what dm3_to_dictionary returns for arrays of structs, eg
+    # complex image data)
+    # 6. other numpy arrays and buffer protocol objects to array dataheader
+    # The grammar can only write array.arrays, so 6. is copied into one.
+    # dm_writer.write_dm writes them without copying.
     # we convert simple python types to a small subset of DM types
     dm_types = {float: 7,
                 int: 3,
@@ -160,14 +235,25 @@ def dict_to_dm3(d):
         simpledata_7 = d
         simpledata_8 = b
         simpledata_9 = b
-        simpledata_10 = b
+        simpledata_10 = B
         simpledata_11 = q
         simpledata_12 = Q"""
-    struct_types = dict(h=2, i=3, H=4, I=5, f=6, d=7, b=8, q=11, Q=12)
+    struct_types = dict(h=2, i=3, H=4, I=5, f=6, d=7, b=8, B=10, q=11,
+                        Q=12)
 
     def data_to_dataheader(data):
         ret = dict()
-        if isinstance(data, tuple):
+        if (np is not None and isinstance(data, np.ndarray)
+                and data.dtype.names):
+            types = array_dm_type(data)[1]
+            ret['dtype'] = 20
+            ret['array_data'] = dict(
+                arraydtype=15,
+                struct_header=dict(num_fields=len(types),
+                                   types=[dict(dtype=t) for t in types]),
+                len=len(data),
+                array=[dict(data=tuple(x)) for x in data.tolist()])
+        elif isinstance(data, tuple):
             # treat as struct
             ret['dtype'] = 15
             ret['struct_header'] = dict(num_fields=len(data),
@@ -178,10 +264,17 @@ def dict_to_dm3(d):
             ret['array_data'] = dict(arraydtype=struct_types[data.typecode],
                                      len=len(data),
                                      array=data)
-        else:
+        elif type(data) in dm_types:
             # simple type
             ret['dtype'] = dm_types[type(data)]
             ret['data'] = data
+        else:
+            # numpy array or buffer
+            dm_type = array_dm_type(data)[0]
+            data = _to_array(data, dm_write_typecodes[dm_type])
+            ret['dtype'] = 20
+            ret['array_data'] = dict(arraydtype=dm_type, len=len(data),
+                                     array=data)
         return ret
 
     def collection_to_section(d):
@@ -209,26 +302,107 @@ def dict_to_dm3(d):
     return dict(section=collection_to_section(d))
 
 def parse_dm3_header(file):
-    g = ParsedGrammar(dm3_grammar, 'header')
+    g = get_grammar('dm3')
     out = g.open(file)
     if out:
         d = dm3_to_dictionary(out)
         return d
 
-def parse_dm_header(file, default_mode="dm3"):
-    # We try to parse a file.
-    # if default_mode shoud be dm3 of dm4, indicating the grammar
-    # to try first. If it fails, the other grammar is tried instead
+def _remaining_size(file):
+    # number of bytes from the current position to the end of file
+    pos = file.tell()
+    file.seek(0, 2)
+    end = file.tell()
+    file.seek(pos)
+    return end - pos
+
+def sniff_dm_grammar_defs(file):
+    """
+    Works out which grammar definitions (dm3_grammar_defs, dm3_grammar_defs2
+    or dm4_grammar_defs) describe file from the version and length fields in
+    its first 16 bytes, without parsing any further. The file position is
+    left unchanged.
+    For dm3 files the header_offset is taken from the difference between the
+    stored length and the real size of the root section. Only the known
+    layouts are returned, so an unusual value (eg from trailing data) gives
+    a warning and dm3_grammar_defs, rather than a new grammar to compile.
+    The size of a CompressedFile is only known once it's been decompressed
+    to the end, so if it isn't yet, dm3_grammar_defs is returned without
+    checking rather than decompressing the whole file just to sniff it.
+    """
+    startpos = file.tell()
+    head = file.read(16)
+    file.seek(startpos)
+    if len(head) < 16:
+        raise ValueError("File is neither a dm3 nor dm4 file!")
+    version, = struct.unpack_from('>l', head)
+    if version == 4:
+        return dm4_grammar_defs
+    elif version != 3:
+        raise ValueError("File is neither a dm3 nor dm4 file!")
+    if isinstance(file, CompressedFile) and file.index.size is None:
+        return dm3_grammar_defs
+    length, = struct.unpack_from('>l', head, 4)
+    # the root section starts after the 12 byte header and is followed by
+    # 8 bytes of zero padding
+    header_offset = length - (_remaining_size(file) - 20)
+    for defs in (dm3_grammar_defs, dm3_grammar_defs2):
+        if defs['header_offset'] == header_offset:
+            return defs
+    logging.warning("Unexpected dm3 header_offset %d, trying %d",
+                    header_offset, dm3_grammar_defs['header_offset'])
+    return dm3_grammar_defs
+
+def parse_dm_header(file, default_mode="dm3", include=None, exclude=None,
+                    index=None, stats=None):
+    # We work out the file type from the first few bytes and parse the
+    # file once with the matching grammar.
+    # Only if that fails (eg trailing data after the tags) do we fall back
+    # to trying each grammar in turn. default_mode shoud be dm3 of dm4,
+    # indicating the grammar to try first in that case.
+    # include and exclude are lists of tag path patterns, eg
+    # ['ImageList/*/ImageData/Dimensions']. When given, the tags are read
+    # with dm_tags instead, which seeks over unwanted tags without
+    # reading them.
+    # index can be a dm_index.TagIndex for file, in which case the wanted
+    # tags are read straight from the offsets it records.
+    # stats can be a dm_stats.DMStats to count the reads, seeks and time
+    # spent in. The grammar itself can't be instrumented, so when it's used
+    # (no include, exclude or index) stats gets the read, seek and byte
+    # totals of the file it reads, split between the 'grammar' and
+    # 'conversion' phases, and its rules stay empty. dm_tags counts every
+    # rule.
+    # Files that can't seek, like pipes, are read in a single pass with
+    # dm_stream.stream_dm_tags instead, and index isn't used.
+    if not seekable(file):
+        return stream_dm_tags(file, include=include, exclude=exclude,
+                              stats=stats)
+    # gzip, bzip2 and xz files are decompressed as they're read
+    file = decompressed(file, stats)
+    if stats is not None:
+        # everything below, the grammar included, reads through this
+        file = stats.wrap(file)
+    if index is not None:
+        with phase(stats, 'index'):
+            return index.read(file, include, exclude)
+    if include is not None or exclude is not None:
+        return read_dm_tags(file, include=include, exclude=exclude,
+                            stats=stats)
+    startpos = file.tell()
     tries = [dm3_grammar, dm3_grammar2, dm4_grammar]
     if default_mode != 'dm3':
-        tries = reversed(tries)
-    startpos = file.tell()
-    for t in tries:
+        tries = tries[::-1]
+    sniffed = replace_map(general_grammar, sniff_dm_grammar_defs(file))
+    if sniffed in tries:
+        tries.remove(sniffed)
+    for t in [sniffed] + tries:
         file.seek(startpos)
-        g = ParsedGrammar(t, 'header')
-        out = g.open(file)
+        g = get_grammar(t)
+        with phase(stats, 'grammar'):
+            out = g.open(file)
         if out is not None:
-            d = dm3_to_dictionary(out)
+            with phase(stats, 'conversion'):
+                d = dm3_to_dictionary(out)
             return d
     raise ValueError("File is neither a dm3 nor dm4 file!")
 
@@ -238,7 +412,7 @@ if __name__ == '__main__':
     import pprint
     logging.basicConfig()
     logging.root.setLevel(logging.DEBUG)
-    g = ParsedGrammar(dm3_grammar, 'header')
+    g = get_grammar('dm3')
     fname = sys.argv[1] if len(sys.argv) > 1 else "rampint32.dm3"
     print("opening " + fname)
 
@@ -1,10 +1,17 @@
 from __future__ import absolute_import, print_function, division
+import bisect
 import os
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from tempfile import mkstemp
 
 from .parse_dm3_grammar import parse_dm_header
 
-from .dm3_image_utils import imagedatadict_to_ndarray
+from .dm3_image_utils import load_preview, open_dm
+from .dm_view_utils import AutoContrast, ImagePyramid
+from .dm_util import LRUCache
 import array
 # mfm 2014-02-04 would like ability to flip through using arrow keys
 # we had this flag in ParseDM3File, but it's been removed.
@@ -29,6 +36,11 @@ try:
 except ImportError:
     has_pil = False
 
+try:
+    from PIL import ImageTk
+except ImportError:
+    ImageTk = None
+
 if not hist_func:
     def my_hist(im, bins, range):
         ret = [0]*bins
@@ -61,6 +73,16 @@ def nparray_to_pgm(stream_out, im, shape):
         stream_out.write(out)
 
 
+def pgm_data(im):
+    """
+    Returns the 2d uint8 array im as the bytes of a binary PGM image, which
+    PhotoImage can take as its data without going through a file.
+    """
+    h, w = im.shape
+    header = ("P5\n%d %d\n255\n" % (w, h)).encode('ascii')
+    return header + np.ascontiguousarray(im, dtype=np.uint8).tobytes()
+
+
 def get_image(dmtag, num):
     im = dmtag['ImageList'][num]['ImageData']['Data']
     with open("dmout.pgm", 'wb') as f:
@@ -75,12 +97,18 @@ class DM3Loader(object):
     A loader should be calable with a path and return an nd
     image. It should have a extensions property that returns a list of
     acceptable extensions for the file
+    If preview_width is given, only a preview that wide is loaded (see
+    load_preview), which is much quicker for big images.
     """
+    def __init__(self, preview_width=None):
+        self.preview_width = preview_width
+
     def __call__(self, path):
-        with open(path, "rb") as f:
-            op = parse_dm_header(f)
-        return imagedatadict_to_ndarray(
-            op['ImageList'][-1]['ImageData'])
+        if self.preview_width:
+            return load_preview(path, self.preview_width, use_thumbnail=False)
+        # only the last image is read, not the thumbnail before it
+        with open_dm(path) as dm:
+            return dm.images[-1].data
 
     @property
     def extensions(self):
@@ -98,39 +126,133 @@ class FolderImageSource(object):
     """
     A source simply has to expose a next(steps) function that will initially
     get called with 0.
+    The folder's sorted listing is kept until the folder changes. The
+    prefetch images either side of the current one are loaded on a pool of
+    workers threads into a cache of at most cache_bytes, so stepping to them
+    doesn't have to wait for them to load.
     """
-    def __init__(self, path, loaders):
+    def __init__(self, path, loaders, prefetch=2, cache_bytes=512 << 20,
+                 workers=2):
         self.path = path
         self.loaders = loaders
+        self.prefetch = prefetch
+        self.cache = LRUCache(cache_bytes)
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=workers) if prefetch else None
+        # (folder, mtime, sorted names, index of each name)
+        self._listing = None
 
     @staticmethod
     def get_extension(path):
         return os.path.splitext(path)[1][1:]
 
-    def get_image_and_title(self):
-        ext = self.get_extension(self.path)
+    def listing(self):
+        """Returns the sorted names of the images in the folder, and a dict
+        of the index of each"""
+        folder = os.path.dirname(self.path) or "."
+        mtime = os.stat(folder).st_mtime
+        if self._listing is None or self._listing[:2] != (folder, mtime):
+            all_exts = [x for loader in self.loaders for x in loader.extensions]
+            names = sorted(x for x in os.listdir(folder)
+                           if self.get_extension(x) in all_exts)
+            self._listing = (folder, mtime, names,
+                             dict((n, i) for i, n in enumerate(names)))
+        return self._listing[2:]
+
+    def load(self, path):
+        ext = self.get_extension(path)
         for l in self.loaders:
             if ext in l.extensions:
-                return l(self.path), os.path.basename(self.path)
+                return l(path)
+
+    def _prefetch(self, path):
+        try:
+            im = self.load(path)
+            if im is not None:
+                self.cache.put(path, im)
+            return im
+        finally:
+            with self.lock:
+                self.pending.pop(path, None)
+
+    def get_image(self, path):
+        im = self.cache.get(path)
+        if im is not None:
+            return im
+        with self.lock:
+            future = self.pending.get(path)
+        if future is not None:
+            try:
+                im = future.result()
+            except Exception:
+                # try again below, so any error is raised here
+                im = None
+        if im is None:
+            im = self.load(path)
+            if im is not None:
+                self.cache.put(path, im)
+        return im
+
+    def start_prefetch(self):
+        """Starts loading the images around the current one"""
+        if not self.prefetch:
+            return
+        names, index = self.listing()
+        name = os.path.basename(self.path)
+        if name not in index or not names:
+            return
+        i = index[name]
+        folder = os.path.dirname(self.path)
+        for d in range(1, self.prefetch + 1):
+            for j in (i + d, i - d):
+                path = os.path.join(folder, names[j % len(names)])
+                with self.lock:
+                    if path in self.pending or path in self.cache:
+                        continue
+                    self.pending[path] = self.pool.submit(self._prefetch,
+                                                          path)
+
+    def get_image_and_title(self):
+        im = self.get_image(self.path)
+        self.start_prefetch()
+        if im is not None:
+            return im, os.path.basename(self.path)
 
     def next(self, delta):
         if delta != 0:
             path, name = os.path.split(self.path)
-            # if path is blank use '.'
-            path = path or "."
-            all_exts = [x for loader in self.loaders for x in loader.extensions]
-            names = [x for x in os.listdir(path)
-                     if self.get_extension(x) in all_exts]
+            names, index = self.listing()
             print("New image from ", self.path)
-            newname = names[(names.index(name) + delta) % len(names)]
+            if name in index:
+                i = index[name]
+            else:
+                # it's gone, carry on from where it would have been
+                i = bisect.bisect_left(names, name) - (delta > 0)
+            newname = names[(i + delta) % len(names)]
             self.path = os.path.join(path, newname)
             print("to", self.path)
         return self.get_image_and_title()
 
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
 
 
 class ImageCanvas(Canvas):
-    def __init__(self, source, limits=None, root=None):
+    """
+    Shows the images from source. Images that don't fit in viewport (or all
+    of them if tiled is True, or none if it's False) are shown tiled: the
+    canvas stays the size of the viewport and only the tiles in view are
+    drawn, from an ImagePyramid level matching the zoom. The mouse wheel
+    zooms by powers of two and dragging pans.
+    """
+    tile_size = 256
+    max_tiles = 256
+    max_zoom_level = 3
+
+    def __init__(self, source, limits=None, root=None, tiled=None,
+                 viewport=(1024, 768), refine_contrast=False):
         self.source = source
         if not root:
             root = Tk()
@@ -140,10 +262,29 @@ class ImageCanvas(Canvas):
         self.root = root
         self.photoimage = self.tkimage = None
         self.histimage = None
-        self.arr = None
+        self.arr = self.histogram = None
+        self.tiled = tiled
+        self.viewport = viewport
+        self.pyramid = None
+        # rendered tiles by (zoom level, tile x, tile y), least recent first
+        self.tiles = OrderedDict()
+        self.tile_items = []
+        self.zoom_level = self.min_zoom_level = 0
+        self.view = [0, 0]
+        # AutoContrast of recent images by title, with a weakref to check
+        # it's still the same image
+        self.contrasts = OrderedDict()
+        self.contrast = None
+        self.refine_contrast = refine_contrast
         Canvas.__init__(self, self.root, width=1, height=1)
         self.pack()
         self.limits = limits or {}
+        self.bind("<ButtonPress-1>", self.start_pan)
+        self.bind("<B1-Motion>", self.pan)
+        self.bind("<MouseWheel>",
+                  lambda e: self.zoom_at(e.x, e.y, 1 if e.delta > 0 else -1))
+        self.bind("<Button-4>", lambda e: self.zoom_at(e.x, e.y, 1))
+        self.bind("<Button-5>", lambda e: self.zoom_at(e.x, e.y, -1))
 
         menubar = None
         if has_pil:
@@ -155,22 +296,32 @@ class ImageCanvas(Canvas):
         self.next_image(0)
         root.mainloop()
         # copied some from demo/tkinter/guido/imagedraw.py
-        # unfortunately PhotoImage only accepts base64 encoded GIF files
-        # while we can specify a PGM filename. We create a temporary file
-        # as a workaround
 
     def clip_im(self, nparr):
-        h, w = nparr.shape
         lo, hi = self.limits
         scale = 255.0 / (hi - lo)
         off = lo
         if use_numpy_arrays:
-            return np.clip(scale * (nparr - off), 0, 255).astype(np.uint8)
+            # in place on a single float32 copy, this runs on every change
+            # of limits so it needs to be quick for big images
+            out = nparr.astype(np.float32)
+            out -= off
+            out *= scale
+            np.clip(out, 0, 255, out=out)
+            return out.astype(np.uint8)
         else:
             return map(lambda x: int(scale*(x-off)), nparr)
 
     @staticmethod
     def make_photoimageim(nparr):
+        if ImageTk is not None:
+            return ImageTk.PhotoImage(PIL.Image.fromarray(nparr))
+        try:
+            # Tk 8.6 reads PGM data straight from memory
+            return PhotoImage(data=pgm_data(nparr))
+        except TclError:
+            pass
+        # older Tks only read PGM files, so we go through a temporary file
         h, w = nparr.shape
         f, fname = mkstemp()
         try:
@@ -191,34 +342,162 @@ class ImageCanvas(Canvas):
         if f:
             PIL.Image.fromarray(self.clip_im(self.arr)).save(f)
 
+    def display_size(self):
+        h, w = self.arr.shape
+        zoom = 2.0 ** self.zoom_level
+        return int(w * zoom), int(h * zoom)
+
+    def make_tile(self, tx, ty):
+        # levels are binned for zooming out, pixels repeated for zooming in
+        level = self.pyramid.level(max(0, -self.zoom_level))
+        repeat = 2 ** max(0, self.zoom_level)
+        size = self.tile_size // repeat
+        part = self.clip_im(level[ty * size:(ty + 1) * size,
+                                  tx * size:(tx + 1) * size])
+        if repeat > 1:
+            part = part.repeat(repeat, axis=0).repeat(repeat, axis=1)
+        return self.make_photoimageim(part)
+
+    def render_tiles(self):
+        """Draws the tiles in view, rendering the ones not cached"""
+        for item in self.tile_items:
+            self.delete(item)
+        self.tile_items = []
+        size = self.tile_size
+        w, h = self.display_size()
+        vw, vh = self.viewport
+        vx, vy = self.view
+        for ty in range(vy // size, (min(h, vy + vh) - 1) // size + 1):
+            for tx in range(vx // size, (min(w, vx + vw) - 1) // size + 1):
+                key = (self.zoom_level, tx, ty)
+                tile = self.tiles.pop(key, None)
+                if tile is None:
+                    tile = self.make_tile(tx, ty)
+                self.tiles[key] = tile
+                self.tile_items.append(self.create_image(
+                    tx * size - vx, ty * size - vy + 1, anchor=NW,
+                    image=tile))
+        while len(self.tiles) > self.max_tiles:
+            self.tiles.popitem(last=False)
+
+    def clamp_view(self):
+        w, h = self.display_size()
+        self.view = [int(min(max(0, self.view[0]), max(0, w - self.viewport[0]))),
+                     int(min(max(0, self.view[1]), max(0, h - self.viewport[1])))]
+
+    def start_pan(self, e):
+        self.pan_start = (e.x, e.y) + tuple(self.view)
+
+    def pan(self, e):
+        if self.pyramid is None:
+            return
+        x, y, vx, vy = self.pan_start
+        self.view = [vx - (e.x - x), vy - (e.y - y)]
+        self.clamp_view()
+        self.render_tiles()
+
+    def zoom_at(self, x, y, step):
+        """Zooms in (step > 0) or out by 2**step, keeping x, y in place"""
+        if self.pyramid is None:
+            return
+        zoom_level = min(max(self.zoom_level + step, self.min_zoom_level),
+                         self.max_zoom_level)
+        if zoom_level == self.zoom_level:
+            return
+        f = 2.0 ** (zoom_level - self.zoom_level)
+        self.view = [(self.view[0] + x) * f - x, (self.view[1] + y) * f - y]
+        self.zoom_level = zoom_level
+        self.clamp_view()
+        self.render_tiles()
+
     def new_limits(self, new_limits):
         self.limits=new_limits
         if self.tkimage is not None:
             self.delete(self.tkimage)
-        npimage = self.clip_im(self.arr)
-        # we need to keep a reference to the photoimage
-        self.photoimage = self.make_photoimageim(npimage)
-        self.tkimage = self.create_image(0, 1, anchor=NW,
-                                          image=self.photoimage)
+            self.tkimage = None
+        if self.pyramid is not None:
+            # every tile has to be drawn again with the new limits
+            self.tiles.clear()
+            self.render_tiles()
+        else:
+            npimage = self.clip_im(self.arr)
+            # we need to keep a reference to the photoimage
+            self.photoimage = self.make_photoimageim(npimage)
+            self.tkimage = self.create_image(0, 1, anchor=NW,
+                                              image=self.photoimage)
         if self.histimage:
             self.histimage.destroy()
         self.histimage = create_histogram(self.arr,
                                            self.root, 128, self.limits,
-                                           self.new_limits)
+                                           self.new_limits, self.histogram)
         self.histimage.place(anchor=NW)
 
+    def auto_contrast(self, im, title):
+        """Returns the AutoContrast for im, from the cache if it's there"""
+        cached = self.contrasts.pop(title, None)
+        if cached is not None and cached[0]() is im:
+            contrast = cached[1]
+        else:
+            contrast = AutoContrast(im)
+            if self.refine_contrast:
+                contrast.refine(im)
+        self.contrasts[title] = (weakref.ref(im), contrast)
+        while len(self.contrasts) > 64:
+            self.contrasts.popitem(last=False)
+        return contrast
+
+    def check_refined(self, contrast, limits):
+        # polled from the Tk thread until the background refine is done
+        if contrast is not self.contrast:
+            return
+        if not contrast.refined:
+            self.after(200, self.check_refined, contrast, limits)
+            return
+        self.histogram = contrast.histogram
+        # only take the new limits if they haven't been changed meanwhile
+        self.new_limits(contrast.limits if self.limits == limits
+                        else self.limits)
+
     # we look for arrow keys..
     def next_image(self, step):
         im, title = self.source.next(step)
         self.arr = im
+        # the limits and histogram come from a sample of the image, and
+        # are kept for when we come back to it
+        self.contrast = self.auto_contrast(im, title)
+        self.histogram = self.contrast.histogram
         self.root.wm_title(title)
         h, w = self.arr.shape
-        self.config(width=w, height=h + 1)  # resize existing canvas
-        limits = (immin(self.arr), immax(self.arr))
-        self.new_limits(limits)
+        vw, vh = self.viewport
+        for item in self.tile_items:
+            self.delete(item)
+        self.tile_items = []
+        self.tiles.clear()
+        tiled = self.tiled
+        if tiled is None:
+            tiled = w > vw or h > vh
+        if tiled:
+            self.pyramid = ImagePyramid(im)
+            # start zoomed out far enough to fit the viewport, and don't go
+            # further out than that
+            fit = max(1.0 * w / vw, 1.0 * h / vh)
+            self.zoom_level = self.min_zoom_level = -int(
+                np.ceil(np.log2(fit))) if fit > 1 else 0
+            self.view = [0, 0]
+            w, h = self.display_size()
+            self.config(width=min(w, vw), height=min(h, vh) + 1)
+        else:
+            self.pyramid = None
+            self.config(width=w, height=h + 1)  # resize existing canvas
+        self.new_limits(self.contrast.limits)
+        if self.refine_contrast and not self.contrast.refined:
+            self.after(200, self.check_refined, self.contrast,
+                       self.contrast.limits)
 
 
-def create_histogram(im, tkroot, size, limits, rangechangefunc):
+def create_histogram(im, tkroot, size, limits, rangechangefunc,
+                     histogram=None):
+    # histogram is an optional ImageHistogram of im, to save counting again
 
     def add_hist_to_photoimage(im, out_pim, back="#D0D0D0", fore="#A0A0DD"):
         """
@@ -226,17 +505,18 @@ def create_histogram(im, tkroot, size, limits, rangechangefunc):
         PhotoImage, out_pim
         """
         hist_width, hist_height = out_pim.width(), out_pim.height()
-        vals, bins = hist_func(im, bins=hist_width,
-                               range=limits)
+        if histogram is not None:
+            vals = histogram.histogram(hist_width, limits)
+        else:
+            vals, bins = hist_func(im, bins=hist_width,
+                                   range=limits)
         # we now create the image
-        # we show 0 to vals.max() in hist_height steps
-        pics = ""
-        for j in range(hist_height, 0, -1):
-            lim = immax(vals) * 1.2 * j / hist_height
-            pics += ("{"
-                     + " ".join(back if x < lim else fore for x in vals)
-                     + "} ")
-        out_pim.put(pics)
+        # we show 0 to vals.max() in hist_height steps, the top row first
+        lims = (immax(vals) * 1.2 / hist_height *
+                np.arange(hist_height, 0, -1))
+        colours = np.where(np.asarray(vals)[None, :] < lims[:, None],
+                           back, fore)
+        out_pim.put(" ".join("{" + " ".join(row) + "}" for row in colours))
 
     hist = PhotoImage(width=size, height=size)
     add_hist_to_photoimage(im, hist)
@@ -268,7 +548,10 @@ def create_histogram(im, tkroot, size, limits, rangechangefunc):
                                 limits[0] + high * full_range))
 
     def reset_click(e):
-        rangechangefunc((immin(im), immax(im)))
+        if histogram is not None:
+            rangechangefunc((histogram.lo, histogram.hi))
+        else:
+            rangechangefunc((immin(im), immax(im)))
 
     canv_hist.bind("<Button-1>", start_click)
     canv_hist.bind("<B1-Motion>", move_click)
@@ -302,8 +585,12 @@ if __name__ == '__main__':
             # arr = imagedatadict_to_ndarray(op['ImageList'][-1]['ImageData'])
             ImageCanvas(FolderImageSource(file, [DM3Loader(), PILLoader()]))
         else:
+            # the dispersion listings only need the PrimaryList tags
+            include = None
+            if action in ("listdispersions", "countdispersions"):
+                include = ["PrimaryList"]
             with open(file, "rb") as f:
-                op = parse_dm_header(f)
+                op = parse_dm_header(f, include=include)
             if action == "listdispersions":
                 for kvlist in op["PrimaryList"]:
                     print("Energy %lf has dispersions:" % kvlist['Prism']['Energy'])
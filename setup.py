@@ -7,6 +7,8 @@ setup(
     name = "DM3Utils",
     version = "0.1",
     packages = ['dm_parser'],
+    # convert_dm, dm_catalog and show_dm3_file use concurrent.futures
+    install_requires = ['futures; python_version < "3"'],
 
 
 
@@ -19,6 +21,10 @@ setup(
     entry_points={
         'gui_scripts': [
             'show_dm_image = dm_parser.show_dm3_file:show_dm_image_script',
+        ],
+        'console_scripts': [
+            'dm_convert = dm_parser.convert_dm:main',
+            'dm_catalog = dm_parser.dm_catalog:main',
         ]
     }
 )